@@ -2,12 +2,15 @@
 import os
 from collections import OrderedDict
 
+import numpy as np
 import pytest
-from ucca import textutil
+from ucca import layer0, textutil
+from ucca.textutil import Attr
 
 from tupa.action import Actions
 from tupa.features.dense_features import DenseFeatureExtractor
-from tupa.features.sparse_features import SparseFeatureExtractor
+from tupa.features.feature_extractor import calc, head_terminal_height
+from tupa.features.sparse_features import SparseFeatureExtractor, stable_hash, value_id
 from tupa.model import Model
 from tupa.oracle import Oracle
 from tupa.states.state import State
@@ -105,6 +108,138 @@ def test_features_conllu(config, feature_extractor_creator, filename, write_feat
     _test_features(config, feature_extractor_creator, filename, write_features)
 
 
+def oracle_states(config, filename):
+    """
+    :return: generator of the states visited by following the oracle
+    """
+    passage = load_passage(filename)
+    config.set_format(passage.extra.get("format") or "ucca")
+    oracle = Oracle(passage)
+    state = State(passage)
+    actions = Actions()
+    while not state.finished:
+        yield state
+        action = min(oracle.get_actions(state, actions).values(), key=str)
+        state.transition(action)
+        if state.need_label:
+            state.label_node(oracle.get_label(state, action)[0])
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_head_terminal_height(config, filename):
+    for state in oracle_states(config, filename):
+        for node in state.nodes:
+            cached = head_terminal_height(node), head_terminal_height(node, return_height=True)
+            node.head_terminal_height = None
+            assert cached == (head_terminal_height(node), head_terminal_height(node, return_height=True)), node
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_terminal_span(config, filename):
+    for state in oracle_states(config, filename):
+        for node in state.nodes:
+            indices = set()
+            stack = [node]
+            while stack:
+                descendant = stack.pop()
+                stack.extend(edge.child for edge in descendant.outgoing if not edge.remote)
+                if descendant.text is not None:
+                    indices.add(descendant.index)
+            assert node.terminal_span == ((min(indices), max(indices), len(indices)) if indices else (0, 0, 0)), node
+
+
+@pytest.mark.parametrize("gap_features", (False, True), ids=("", "gaps"))
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_gap_features(config, filename, gap_features):
+    config.update(dict(gap_features=gap_features))
+    for state in oracle_states(config, filename):
+        for node in state.nodes:
+            first, last, count = node.terminal_span
+            expected = (last - first + 1 - count if count else 0) if gap_features else None
+            assert calc(node, state, "y") == expected, node
+            if node.text is None:
+                assert (calc(node, state, "x") is None) == (not gap_features), node
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_punctuation_between(config, filename):
+    state = next(oracle_states(config, filename))
+    for first in state.terminals:
+        for last in state.terminals[first.index - 1:]:
+            punctuation = [t for t in state.terminals[first.index:last.index - 1] if t.tag == layer0.NodeTags.Punct]
+            assert state.punctuation_between(first.index, last.index) == \
+                (len(punctuation), punctuation[0] if punctuation else None), (first, last)
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_token_attributes(config, filename):
+    state = next(oracle_states(config, filename))
+    for terminal in state.terminals:
+        tok = terminal.orig_node.tok
+        for attr in Attr:
+            expected = tok[attr.value] if tok is not None and attr.value < len(tok) else None
+            assert state.token_attributes[terminal.index - 1, attr.value] is expected, (terminal, attr)
+            assert terminal.tok[attr.value] is expected, (terminal, attr)
+
+
+@pytest.mark.parametrize("feature_extractor_creator", feature_extractors(), ids=str)
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+@pytest.mark.parametrize("missing_node_features", (False, True), ids=("", "missing"))
+@pytest.mark.parametrize("fork", (False, True), ids=("", "fork"))
+def test_differential_features(config, feature_extractor_creator, filename, missing_node_features, fork):
+    config.update(dict(check_features=True,  # Every extraction is compared to full extraction
+                       missing_node_features=missing_node_features))
+    feature_extractor = feature_extractor_creator(config)
+    for state in oracle_states(config, filename):
+        feature_extractor.extract_features(state)
+        if fork and state.buffer:  # Like beam search, alternate between states (forked states copy their nodes)
+            forked = state.fork()
+            forked.transition(Actions.Shift())
+            feature_extractor.extract_features(forked)
+            feature_extractor.extract_features(state)
+
+
+@pytest.mark.parametrize("table_size", (0, 1000), ids=("", "table"))
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_feature_hashing(config, filename, table_size):
+    feature_extractor = SparseFeatureExtractor()
+    hashing_feature_extractor = SparseFeatureExtractor(hashing=True, table_size=table_size)
+    ids = {}
+    features_by_id = {}
+    for state in oracle_states(config, filename):
+        features = feature_extractor.extract_features(state)
+        feature_ids = hashing_feature_extractor.extract_features(state)
+        assert all(0 <= i < (table_size or 1 << 64) for i in feature_ids)
+        if not table_size:  # Both are in template order, and without a table, collisions are practically impossible
+            assert list(features.values()) == list(feature_ids.values())
+            for feature, feature_id in zip(features, feature_ids):
+                assert ids.setdefault(feature, feature_id) == feature_id, feature
+                assert features_by_id.setdefault(feature_id, feature) == feature, feature
+
+
+def test_value_id():
+    for value in (1, True, 0, False, 1.0, "1"):  # Equal values with different types must not share a cached id
+        assert value_id(value) == stable_hash(value)
+
+
+@pytest.mark.parametrize("num_offset", (0, 1), ids=("", "num"))
+@pytest.mark.parametrize("indexed", (False, True), ids=("", "indexed"))
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_extract_arrays(config, filename, indexed, num_offset):
+    feature_extractor, array_feature_extractor = [FeatureExtractorCreator(DENSE, indexed=indexed)(config)
+                                                  for _ in range(2)]  # Each one counts the values it looks up
+    for param in array_feature_extractor.params.values():  # The layout must follow the values, not the num
+        param.num += num_offset
+    for i, state in enumerate(oracle_states(config, filename)):
+        np.random.seed(i)
+        features = sorted(feature_extractor.extract_features(state).items())
+        np.random.seed(i)
+        arrays = list(array_feature_extractor.extract_arrays(state).items())
+        assert [key for key, _ in features] == [key for key, _ in arrays]
+        for (key, values), (_, array) in zip(features, arrays):
+            assert np.allclose(values, array), key
+
+
 @pytest.mark.parametrize("feature_extractor_creator", [f for o in (None, OMITTED)
                                                        for f in feature_extractors(omit=o)[:-1]], ids=str)
 def test_feature_templates(config, feature_extractor_creator, write_features):
@@ -1,9 +1,13 @@
 """Testing code for the tupa.model module, unit-testing only."""
 
 import os
+
+import numpy as np
 import pytest
 
-from tupa.config import CLASSIFIERS
+from tupa.action import Actions
+from tupa.config import CLASSIFIERS, SPARSE
+from tupa.features.sparse_features import SparseFeatureExtractor
 from tupa.model import Model, ClassifierProperty, NODE_LABEL_KEY
 from tupa.states.state import State
 from .conftest import remove_existing, weight_decay, assert_all_params_equal
@@ -47,3 +51,48 @@ def test_model(model_type, formats, test_passage, iterations, omit_features, con
         loaded_param = loaded.feature_extractor.params[key]
         assert param == loaded_param
     assert_all_params_equal(finalized.all_params(), loaded.all_params(), decay=weight_decay(model))
+
+
+def test_aligned_scores(config):
+    config.update(dict(classifier=SPARSE))
+    config.set_format("ucca")
+    model1, model2 = models = [Model("test_files/models/aligned%d" % i, config=config) for i in (1, 2)]
+    for model in models:
+        model.init_model("ucca")
+    labels1, labels2 = [model.classifier.labels["ucca"] for model in models]
+    for action in Actions.LeftEdge("A"), Actions.RightEdge("P"):
+        labels1.generate_id(action)
+    for action in Actions.RightEdge("P"), Actions.RightEdge("D"):
+        labels2.generate_id(action)
+    scores = np.arange(1, len(labels2.all) + 1, dtype=float)
+
+    def expected():
+        by_str = dict(zip(map(str, labels2.all), scores))
+        return [by_str.get(str(action), 0) for action in labels1.all]
+    assert list(model2.aligned_scores(scores, "ucca", labels1.all)) == expected()
+    labels2.generate_id(Actions.LeftEdge("A"))  # Index is updated when labels are added
+    scores = np.append(scores, 10)
+    assert list(model2.aligned_scores(scores, "ucca", labels1.all)) == expected()
+
+
+def test_feature_hashing(formats, test_passage, config):
+    filename = os.path.join("test_files", "models", "test_hashing")
+    remove_existing(filename)
+    config.update(dict(classifier=SPARSE, feature_hashing=True, feature_table_size=1000))
+    model = Model(filename, config=config)
+    parse(formats, model, test_passage, train=True)
+    finalized = model.finalize(finished_epoch=True)
+    finalized.save()
+    config.update(dict(feature_hashing=False, feature_table_size=0))
+    loaded = Model(filename, config=config)
+    loaded.load()
+    assert loaded.feature_extractor.hashing  # The scheme is restored from the model, not from the current config
+    assert loaded.feature_extractor.table_size == 1000
+    assert_all_params_equal(finalized.all_params(), loaded.all_params())
+    state = State(test_passage)
+    feature_ids = SparseFeatureExtractor(hashing=True).extract_features(state)
+    for table_size in 1, 2, 1000:  # Colliding features share an id with the sum of their values, none is lost
+        folded = SparseFeatureExtractor(hashing=True, table_size=table_size).extract_features(state)
+        assert sum(folded.values()) == pytest.approx(sum(feature_ids.values()))
+        assert len(folded) <= table_size
+    assert SparseFeatureExtractor(hashing=True, table_size=1).extract_features(state) == {0: sum(feature_ids.values())}
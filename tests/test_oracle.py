@@ -1,10 +1,12 @@
 """Testing code for the tupa.oracle module, unit-testing only."""
+from contextlib import contextmanager
 
 import pytest
+from semstr.constraints import Direction
 
 from tupa.action import Actions
 from tupa.oracle import Oracle
-from tupa.states.state import State
+from tupa.states.state import State, InvalidActionError
 from .conftest import passage_files, Settings, load_passage, basename
 
 
@@ -42,3 +44,116 @@ def gen_actions(passage):
         yield s
         if state.finished:
             break
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_valid_actions_mask(config, filename):
+    for state, actions, action in gen_states(config, filename):
+        mask = state.valid_actions_mask(actions)
+        assert mask.tolist() == [is_valid_uncached(state, a) for a in actions.all], state
+        assert mask[action.id], action
+        assert state.single_valid_action(actions) == (mask.argmax() if mask.sum() == 1 else None), state
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_is_descendant(config, filename):
+    for state, _, _ in gen_states(config, filename):
+        for node in state.nodes:
+            assert [n.index for n in state.nodes if state.is_descendant(n, node)] == \
+                sorted(n.index for n in node.descendants), node
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_hash(config, filename):
+    for state, _, _ in gen_states(config, filename):
+        assert (state.stack_hash, state.buffer_hash, state.edges_hash) == state.calculate_hashes(), state
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_counters(config, filename):
+    for state, _, _ in gen_states(config, filename):
+        non_terminals = [n for n in state.nodes if not (n.is_root or n.is_linkage or n.text)]
+        assert state.non_terminals == len(non_terminals), state
+        assert state.parentless == sum(1 for n in non_terminals if not n.incoming), state
+        assert state.unlabeled == sum(1 for n in state.nodes if not (n.text or n.labeled)), state
+        assert -state.head_heights[0][0] == max(head.height for head in state.heads), state
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_constraint_tables(config, filename):
+    for state, actions, _ in gen_states(config, filename):
+        tags = {a.tag for a in actions.all if isinstance(a.tag, str)}
+        for node in state.nodes:
+            for tag in tags:
+                for direction in Direction:
+                    rule = state.constraint_tables.violated_rule(node, tag, direction)
+                    violations = [r for r in state.constraints.tag_rules if r.violation(node, tag, direction) is not None]
+                    assert rule is (violations[0] if violations else None), (node, tag, direction)
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_fork(config, filename):
+    forks = []
+    state = None
+    for state, _, _ in gen_states(config, filename):
+        forks.append((state.fork(), state_str(state)))
+    state.create_passage(verify=False)
+    for fork, expected in forks:
+        assert state_str(fork) == expected  # Unaffected by the transitions applied to the original state since
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_release(config, filename):
+    for state, _, _ in gen_states(config, filename):
+        state.fork().release()  # Dropped right away, so the state need not copy anything to change
+        assert not any(map(state._own, ("graph", "sequence", "history")))
+
+
+@pytest.mark.parametrize("filename", passage_files(), ids=basename)
+def test_create_passage(config, filename, monkeypatch):
+    config.update(Settings("implicit", "linkage").dict())  # So that all kinds of nodes and edges are created
+    state = None
+    for state, _, _ in gen_states(config, filename):
+        pass
+    passage = state.fork().create_passage(verify=False)
+    monkeypatch.setattr("tupa.states.state.bulk_creation", contextmanager(lambda *layers: iter([None])))
+    expected = state.fork().create_passage(verify=False)  # Sorted after every node and edge added, as by ucca
+    assert passage_str(passage) == passage_str(expected)
+
+
+def passage_str(passage):
+    l1 = passage.layer("1")
+    return "\n".join(["%s: %s | %s" % (node.ID, ", ".join(e.ID + e.tag for e in node),
+                                        ", ".join(e.ID for e in node.incoming))
+                      for layer in passage.layers for node in layer.all] +
+                     [" ".join(node.ID for node in nodes) for layer in passage.layers for nodes in [layer.heads]] +
+                     [" ".join(node.ID for node in nodes) for nodes in (l1.top_scenes, l1.top_linkages)])
+
+
+def state_str(state):
+    return "\n".join([str(state)] + ["%s: %s" % (node, ", ".join(map(str, node.outgoing))) for node in state.nodes])
+
+
+def gen_states(config, filename):
+    """
+    :return: generator of (state, actions, oracle action) for each state visited by following the oracle
+    """
+    passage = load_passage(filename)
+    config.set_format(passage.extra.get("format") or "ucca")
+    oracle = Oracle(passage)
+    state = State(passage)
+    actions = Actions()
+    while not state.finished:
+        action = min(oracle.get_actions(state, actions).values(), key=str)
+        yield state, actions, action
+        state.transition(action)
+        if state.need_label:
+            state.label_node(oracle.get_label(state, action)[0])
+
+
+def is_valid_uncached(state, action):
+    try:
+        state.check_valid_action(action)
+    except InvalidActionError:
+        return False
+    return True
@@ -1,12 +1,15 @@
 """Testing code for the tupa package, unit-testing only."""
 
+import json
+from collections import Counter
+
 import pytest
 from numpy.testing import assert_allclose
 from semstr.evaluate import Scores
-from ucca import convert
+from ucca import convert, layer1
 
 from tupa.config import SPARSE, MLP, BIRNN, HIGHWAY_RNN, NOOP, Iterations
-from tupa.parse import Parser, ParserException
+from tupa.parse import Parser, ParserException, PassageParser
 from .conftest import FORMATS, remove_existing, passage_files, load_passage, weight_decay, assert_all_params_equal
 
 CLASSIFIERS = (SPARSE, BIRNN, NOOP)
@@ -95,6 +98,177 @@ def test_ensemble(config, model_type):
     list(Parser(model_files=filenames, config=config).parse(passages, evaluate=True))
 
 
+@pytest.mark.parametrize("model_type", (SPARSE, MLP, BIRNN))
+def test_batch_size(config, model_type):
+    filename = "test_files/models/%s_%s_batch_size" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=2))
+    results = []
+    for batch_size in 1, 2:
+        config.update(dict(batch_size=batch_size))
+        results.append(list(p.parse(passages, evaluate=True)))
+    for (passage1, scores1), (passage2, scores2) in zip(*results):
+        assert passage1.ID == passage2.ID
+        assert scores1.average_f1() == pytest.approx(scores2.average_f1())
+
+
+@pytest.mark.parametrize("model_type", (NOOP,))
+def test_forced_actions(config, model_type, capsys):
+    filename = "test_files/models/%s_%s_forced_actions" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=1))
+    capsys.readouterr()
+    list(p.parse(passages))
+    assert "Skipped classifier for " in capsys.readouterr().out  # Once the root is reduced, only SHIFT is valid
+
+
+@pytest.mark.parametrize("model_type", (SPARSE, BIRNN))
+def test_workers(config, model_type):
+    filename = "test_files/models/%s_%s_workers" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=2))
+    results = []
+    for workers in 1, 2:
+        config.update(dict(workers=workers))
+        results.append(list(p.parse(passages, evaluate=True)))
+    assert [passage.ID for passage, _ in results[1]] == [passage.ID for passage in passages]
+    for (passage1, scores1), (passage2, scores2) in zip(*results):
+        assert passage1.ID == passage2.ID
+        assert scores1.average_f1() == pytest.approx(scores2.average_f1())
+
+
+@pytest.mark.parametrize("model_type", (SPARSE, MLP, BIRNN))
+@pytest.mark.parametrize("beam_steps", (None, 3))
+def test_beam(config, model_type, beam_steps, capsys):
+    filename = "test_files/models/%s_%s_beam" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    list(Parser(model_files=filename, config=config).train(passages, dev=passages, iterations=2))
+    config.update(dict(beam_steps=beam_steps))
+    p = Parser(model_files=filename, config=config, beam=3)
+    list(p.train())
+    capsys.readouterr()
+    results = list(p.parse(passages, evaluate=True))
+    assert [passage.ID for passage, _ in results] == [passage.ID for passage in passages]
+    for passage, scores in results:
+        assert passage.layer(layer1.LAYER_ID).heads[0].children, "Beam search should produce a parse"
+    assert "correct actions" in capsys.readouterr().out  # The chosen states' actions are counted
+
+
+@pytest.mark.parametrize("model_type", (SPARSE,))
+def test_beam_greedy(config, model_type, tmpdir, monkeypatch):
+    filename = "test_files/models/%s_%s_beam_greedy" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type, beam_steps=None, batch_size=1, workers=1, pipeline=False))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    list(Parser(model_files=filename, config=config).train(passages, dev=passages, iterations=2))
+    counts = []
+    for beam in True, False:  # Beam search with --beam 1 takes the same actions as greedy parsing, and counts them
+        monkeypatch.setattr(PassageParser, "beam", property(lambda self, b=beam: b and not self.training))
+        config.update(dict(action_stats=str(tmpdir.join("action_stats_%s.csv" % beam))))
+        p = Parser(model_files=filename, config=config, beam=1)
+        list(p.parse(passages, evaluate=True))
+        assert len(p.accuracies) == len(passages)
+        counts.append((p.accuracies, [dict(getattr(p.action_stats, attr))
+                                      for attr in ("predicted", "taken", "true", "confusion")]))
+    assert counts[0] == counts[1]
+
+
+@pytest.mark.parametrize("model_type", (SPARSE,))
+@pytest.mark.parametrize("workers", (1, 2))
+def test_pipeline(config, model_type, workers, tmpdir, capsys):
+    filename = "test_files/models/%s_%s_pipeline" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=2))
+    results = [list(p.parse(passages, evaluate=True))]
+    config.update(dict(pipeline=True, workers=workers, outdir=str(tmpdir)))
+    capsys.readouterr()
+    results.append(list(p.parse(passages, evaluate=True, write=True)))
+    assert "Waiting time per stage" in capsys.readouterr().out
+    for (passage1, scores1), (passage2, scores2) in zip(*results):
+        assert passage1.ID == passage2.ID
+        assert scores1.average_f1() == pytest.approx(scores2.average_f1())
+        assert tmpdir.join(passage2.ID + ".xml").check()
+
+
+@pytest.mark.parametrize("model_type", (SPARSE,))
+@pytest.mark.parametrize("batch_size", (1, 2))
+def test_timeout(config, model_type, batch_size, capsys):
+    filename = "test_files/models/%s_%s_timeout" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type, timeout=1e-9))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    capsys.readouterr()
+    list(p.train(passages, iterations=1))
+    assert "(timeout)" not in capsys.readouterr().out  # Training ignores the timeout
+    config.update(dict(batch_size=batch_size))
+    results = list(p.parse(passages))
+    assert [passage.ID for passage, in results] == [passage.ID for passage in passages]
+    for passage, in results:  # Timed out before the first transition, so nothing is attached to the root
+        assert not passage.layer(layer1.LAYER_ID).heads[0].children
+
+
+@pytest.mark.parametrize("model_type", (SPARSE,))
+@pytest.mark.parametrize("batch_size", (1, 2))
+def test_timing(config, model_type, batch_size, tmpdir, capsys):
+    filename = "test_files/models/%s_%s_timing" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=2))
+    config.update(dict(timing=True, batch_size=batch_size, testscores=str(tmpdir.join("test.csv"))))
+    capsys.readouterr()
+    list(p.parse(passages, evaluate=True))
+    assert "Time per phase" in capsys.readouterr().out
+    with open(str(tmpdir.join("test.timing.json"))) as f:
+        times = json.load(f)
+    assert sorted(times["passages"]) == sorted(passage.ID for passage in passages)
+    for phase in "features", "scoring", "transition", "passage":
+        assert times["total"][phase]["count"] > 0, phase
+        assert times["total"][phase]["count"] == sum(t[phase]["count"] for t in times["passages"].values()) or \
+            batch_size > 1 and phase in ("features", "scoring")  # Scored per batch rather than per passage
+
+
+@pytest.mark.parametrize("model_type", (SPARSE,))
+@pytest.mark.parametrize("workers", (1, 2))
+def test_action_stats(config, model_type, workers, tmpdir):
+    filename = "test_files/models/%s_%s_action_stats" % (FORMATS[0], model_type)
+    remove_existing(filename)
+    config.update(dict(classifier=model_type))
+    passages = list(map(load_passage, passage_files(FORMATS[0])))
+    p = Parser(model_files=filename, config=config)
+    list(p.train(passages, dev=passages, iterations=2))
+    stats_file = tmpdir.join("action_stats.csv")
+    config.update(dict(action_stats=str(stats_file), workers=workers))
+    p = Parser(model_files=filename, config=config)
+    list(p.parse(passages))
+    taken = p.action_stats.taken[FORMATS[0]]
+    rows = stats_file.read().splitlines()
+    assert sum(taken.values()) == len(rows) > 0
+    assert taken == Counter(row.split(",")[1] for row in rows)
+    assert sum(p.action_stats.confusion[FORMATS[0]].values()) == sum(1 for row in rows if row.count(",") > 1)
+    if workers > 1:  # Rows are written in input order by the main process, as without workers
+        sequential_file = tmpdir.join("action_stats_sequential.csv")
+        config.update(dict(action_stats=str(sequential_file), workers=1, batch_size=1))  # Passage by passage
+        list(Parser(model_files=filename, config=config).parse(passages))
+        assert rows == sequential_file.read().splitlines()
+
+
 @pytest.mark.parametrize("model_type", (BIRNN,))
 def test_empty_features(empty_features_config, model_type):
     filename = "test_files/models/%s_%s_empty_features" % (FORMATS[0], model_type)
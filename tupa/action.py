@@ -74,6 +74,7 @@ class Actions(Labels):
         super().__init__(size=size)
         self._all = None
         self._ids = None
+        self._type_indices = None
         if actions is not None:
             self.all = actions
 
@@ -94,6 +95,7 @@ class Actions(Labels):
     def all(self, actions):
         self._all = [Action(**a) if isinstance(a, dict) else a for a in actions]
         self._ids = {(action.type_id, action.tag): i for i, action in enumerate(self._all)}
+        self._type_indices = None
         for action in self._all:
             self.generate_id(action)
 
@@ -103,6 +105,17 @@ class Actions(Labels):
             self.init()
         return self._ids
 
+    @property
+    def type_indices(self):
+        """
+        :return: dict of action type ID -> list of indices in self.all of the actions with this type
+        """
+        if self._type_indices is None or sum(map(len, self._type_indices.values())) != len(self.all):
+            self._type_indices = {}
+            for i, action in enumerate(self.all):
+                self._type_indices.setdefault(action.type_id, []).append(i)
+        return self._type_indices
+
     def generate_id(self, action, create=True):
         if action.id is None:
             key = (action.type_id, action.tag)
@@ -0,0 +1,63 @@
+from collections import Counter, defaultdict
+
+FLUSH_EVERY = 10000  # Maximum number of rows to keep in memory before writing them
+
+
+class ActionStats:
+    """
+    Counts of predicted, taken and true actions per format, and of (true, predicted) pairs for a confusion matrix.
+    Rows for the --action-stats CSV file are kept in memory, and written in bulk by flush().
+    Worker processes set keep_rows, so that their rows are written by the main process (see update), not interleaved.
+    :param filename: CSV file to append rows to, if any
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.predicted = defaultdict(Counter)  # format -> action string -> count
+        self.taken = defaultdict(Counter)
+        self.true = defaultdict(Counter)
+        self.confusion = defaultdict(Counter)  # format -> (true action string, predicted action string) -> count
+        self.rows = []
+        self.keep_rows = False  # Whether to leave the rows for update() in another process rather than writing them
+
+    def add(self, format, predicted, taken, true_actions):
+        """
+        Count one transition
+        :param format: format of the passage being parsed
+        :param predicted: action predicted by the classifier
+        :param taken: action actually applied
+        :param true_actions: list of actions the oracle considered correct (empty if there is no oracle)
+        """
+        predicted, taken, true_actions = str(predicted), str(taken), list(map(str, true_actions))
+        self.predicted[format][predicted] += 1
+        self.taken[format][taken] += 1
+        self.true[format].update(true_actions)
+        if true_actions:
+            self.confusion[format][predicted if predicted in true_actions else "|".join(true_actions), predicted] += 1
+        if self.filename:
+            self.rows.append(",".join([predicted, taken] + true_actions))
+            if len(self.rows) >= FLUSH_EVERY:
+                self.flush()
+
+    def flush(self):
+        """
+        Append all rows kept so far to the CSV file, with a single write
+        """
+        if self.rows and not self.keep_rows:
+            try:
+                with open(self.filename, "a") as f:
+                    f.write("\n".join(self.rows) + "\n")
+            except OSError:
+                pass
+            self.rows = []
+
+    def update(self, other):
+        """
+        Add the counts of another ActionStats object to these ones, and its rows if it kept them rather than writing
+        """
+        for attr in "predicted", "taken", "true", "confusion":
+            for format, counts in getattr(other, attr).items():
+                getattr(self, attr)[format].update(counts)
+        if self.filename:
+            self.rows += other.rows
+            if len(self.rows) >= FLUSH_EVERY:
+                self.flush()
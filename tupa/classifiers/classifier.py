@@ -38,6 +38,15 @@ class Classifier:
         if not self.is_frozen:
             self._update_num_labels()
 
+    def score_batch(self, features, axis):
+        """
+        Calculate scores for several states at once
+        :param features: list of extracted feature values, one per state
+        :param axis: axis of the label we are predicting
+        :return: list of arrays with score for each label, one per state
+        """
+        return [self.score(f, axis) for f in features]
+
     def init_features(self, features, axes, train=False, passage=None, lang=None):
         pass
 
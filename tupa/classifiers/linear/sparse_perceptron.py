@@ -65,7 +65,7 @@ class FeatureWeightsCreator:
 class SparsePerceptron(Classifier):
     """
     Multi-class averaged perceptron with min-update for sparse features.
-    Keeps weights in a dictionary by feature name, allowing adding new features on-the-fly.
+    Keeps weights in a dictionary by feature name (or hashed id), allowing adding new features on-the-fly.
     Also allows adding new labels on-the-fly.
     Expects features from SparseFeatureExtractor.
     """
@@ -109,7 +109,7 @@ class SparsePerceptron(Classifier):
     def score(self, features, axis):
         """
         Calculate score for each label
-        :param features: extracted feature values, in the form of a dict (name -> value)
+        :param features: extracted feature values, in the form of a dict (name or hashed id -> value)
         :param axis: axis of the label we are predicting
         :return: array with score for each label
         """
@@ -197,6 +197,8 @@ class SparsePerceptron(Classifier):
         d.update((
             ("initial_learning_rate", self.initial_learning_rate),
             ("min_update", self.min_update),
+            ("feature_hashing", self.config.args.feature_hashing),
+            ("feature_table_size", self.config.args.feature_table_size),
         ))
         save_dict(filename + ".data", self.copy_model())
 
@@ -209,7 +211,7 @@ class SparsePerceptron(Classifier):
 
     def all_params(self):
         d = super().all_params()
-        d.update(("_".join((axis, k)), v.weights) for axis, model in self.model.items() for k, v in model.items())
+        d.update(("%s_%s" % (axis, k), v.weights) for axis, model in self.model.items() for k, v in model.items())
         return d
 
     def print_params(self, max_rows=10):
@@ -70,6 +70,18 @@ class MultilayerPerceptron(SubModel):
         :param train: are we training now?
         :return: output vector of size self.output_dim
         """
+        return self.apply_layers(self.concatenate_inputs(inputs), train=train)
+
+    def evaluate_batch(self, inputs, train=False):
+        """
+        Apply all MLP layers to several concatenated inputs at once, as one DyNet batch
+        :param inputs: list of (key, vector) per feature type, for each batch element
+        :param train: are we training now?
+        :return: batched output vector of size self.output_dim
+        """
+        return self.apply_layers(dy.concatenate_to_batch([self.concatenate_inputs(i) for i in inputs]), train=train)
+
+    def concatenate_inputs(self, inputs):
         input_keys, inputs = list(map(list, zip(*list(inputs))))
         if self.input_keys:
             assert input_keys == self.input_keys, "Got:     %s\nBut expected input keys: %s" % (
@@ -87,7 +99,9 @@ class MultilayerPerceptron(SubModel):
                                      if d < max_dim else i for i, d in zip(inputs, input_dims)]) * gates
             # Possibly multiple "attention heads" -- concatenate outputs to one vector
             inputs = [dy.reshape(x, (x.dim()[0][0] * x.dim()[0][1],))]
-        x = dy.concatenate(inputs)
+        return dy.concatenate(inputs)
+
+    def apply_layers(self, x, train=False):
         assert len(x.dim()[0]) == 1, "Input should be a vector, but has dimension " + str(x.dim()[0])
         dim = x.dim()[0][0]
         if self.input_dim:
@@ -322,7 +322,7 @@ class NeuralNetwork(Classifier, SubModel):
             if param.numeric:
                 yield key, dy.inputVector(values)
             elif param.indexed:  # collect indices to be looked up
-                indices += values  # DenseFeatureExtractor collapsed features so there are no repetitions between them
+                indices.extend(values)  # DenseFeatureExtractor collapsed features so they do not repeat
             elif lookup is None:  # ignored
                 continue
             else:  # lookup feature
@@ -339,7 +339,7 @@ class NeuralNetwork(Classifier, SubModel):
     def evaluate(self, features, axis, train=False):
         """
         Apply MLP and log softmax to input features
-        :param features: dictionary of key, values for each feature type
+        :param features: dictionary of key, values for each feature type (or DenseFeatures, which behaves like one)
         :param axis: axis of the label we are predicting
         :param train: whether to apply dropout
         :return: expression corresponding to log softmax applied to MLP output
@@ -370,6 +370,27 @@ class NeuralNetwork(Classifier, SubModel):
         self.config.print("  no updates done yet, returning zero vector.", level=4)
         return np.zeros(num_labels)
 
+    def score_batch(self, features, axis):
+        """
+        Calculate score for each label for several states, applying the MLP to all of them as one batch
+        With a BiRNN, the features of all states refer to its inputs, so the states must be of the same passage
+        :param features: list of extracted feature values, one per state
+        :param axis: axis of the label we are predicting
+        :return: list of arrays with score for each label, one per state
+        """
+        if not self.is_frozen:
+            self._update_num_labels()
+        num_labels = self.num_labels[axis]
+        if self.updates > 0 and num_labels > 1 and features:
+            self.init_model(axis)
+            value = self.axes[axis].mlp.evaluate_batch([self.generate_inputs(f, axis) for f in features])
+            if dynet_config.gpu():  # RestrictedLogSoftmax is not implemented for GPU
+                value = dy.to_device(value, 'CPU')
+            value = dy.log_softmax(value, restrict=list(range(num_labels))).npvalue()
+            return list(value.reshape((-1, len(features))).T[:, :num_labels])  # Batch dimension is last
+        self.config.print("  no updates done yet, returning zero vectors.", level=4)
+        return [np.zeros(num_labels) for _ in features]
+
     def update(self, features, axis, pred, true, importance=None):
         """
         Update classifier weights according to predicted and true labels
@@ -92,11 +92,14 @@ def add_param_arguments(ap=None, arg_default=None):  # arguments with possible f
     add(group, "--swap-importance", type=float, default=1, help="learning rate factor for Swap")
     add(group, "--max-training-per-format", type=int, help="max number of training passages per format per iteration")
     add_boolean(group, "missing-node-features", "allow node features to be missing if not available", default=True)
+    add_boolean(group, "gap-features", "calculate the gap features (x, y) of non-terminals from their terminal spans")
     add(group, "--omit-features", help="string of feature properties to omit, out of " + FEATURE_PROPERTIES)
     add_boolean(group, "curriculum", "sort training passages by action prediction accuracy in previous epoch")
 
     group = ap.add_argument_group(title="Perceptron parameters")
     add(group, "--min-update", type=int, default=5, help="minimum #updates for using a feature")
+    add_boolean(group, "feature-hashing", "identifying features by hashed integer ids rather than by strings")
+    add(group, "--feature-table-size", type=int, default=0, help="with feature hashing, number of ids (0: 64-bit ids)")
     SPARSE_ARG_NAMES.update(get_group_arg_names(group))
 
     group = ap.add_argument_group(title="Neural network parameters")
@@ -264,13 +267,25 @@ class Config(object, metaclass=Singleton):
         ap.add_argument("-m", "--models", nargs="+", help="model file basename(s) to load/save, ensemble if >1 "
                                                           "(default: <format>_<model_type>")
         ap.add_argument("-c", "--classifier", choices=CLASSIFIERS, default=BIRNN, help="model type")
-        ap.add_argument("-B", "--beam", type=int, choices=(1,), default=1, help="beam size for beam search")
+        ap.add_argument("-B", "--beam", type=int, default=1, help="beam size for beam search (1 for greedy parsing)")
+        ap.add_argument("--beam-steps", type=int, help="max number of transitions per passage to apply with beam "
+                                                       "search, after which parsing continues greedily")
         add_boolean_option(ap, "evaluate", "evaluation of parsed passages", short="e")
         add_verbose_arg(ap, help="detailed parse output")
         constructions.add_argument(ap)
         add_boolean_option(ap, "sentences", "split to sentences")
         add_boolean_option(ap, "paragraphs", "split to paragraphs")
-        ap.add_argument("--timeout", type=float, help="max number of seconds to wait for a single passage")
+        ap.add_argument("--timeout", type=float, help="max number of seconds to spend on parsing a single passage "
+                                                      "(not in training), after which it is output partially parsed")
+        ap.add_argument("--batch-size", type=int, default=1, help="number of passages to parse in lockstep when not "
+                                                                  "training, scoring all their states in one batch")
+        add_boolean_option(ap, "pipeline", "reading, annotation, parsing and writing of passages in concurrent threads")
+        ap.add_argument("--pipeline-queue-size", type=int, default=10, help="max number of passages waiting between "
+                                                                            "stages when using --pipeline")
+        ap.add_argument("--workers", type=int, default=1, help="number of processes to parse passages in parallel "
+                                                               "when not training, each with its own copy of the model")
+        add_boolean_option(ap, "differential-features", "recomputing at each step only features of nodes that changed",
+                           default=True)
 
         group = ap.add_argument_group(title="Training parameters")
         group.add_argument("-t", "--train", nargs="+", default=(), help="passage files/directories to train on")
@@ -293,7 +308,10 @@ class Config(object, metaclass=Singleton):
         group.add_argument("-l", "--log", help="output log file (default: model filename + .log)")
         group.add_argument("--devscores", help="output CSV file for dev scores (default: model filename + .dev.csv)")
         group.add_argument("--testscores", help="output CSV file for test scores (default: model filename + .test.csv)")
-        group.add_argument("--action-stats", help="output CSV file for action statistics")
+        group.add_argument("--action-stats", help="output CSV file for action statistics (also counted in memory, see "
+                                                   "Parser.action_stats)")
+        add_boolean_option(group, "timing", "timing each parsing phase, written as JSON next to --testscores "
+                                            "(with extension .timing.json)")
         add_boolean_option(group, "normalize", "apply normalizations to output in case format is UCCA", default=False)
         ap.add_argument("-f", "--formats", nargs="+", choices=FILE_FORMATS, default=(),
                         help="input formats for creating all parameters before training starts "
@@ -307,6 +325,7 @@ class Config(object, metaclass=Singleton):
         add_boolean_option(group, "check-loops", "check for parser state loop")
         add_boolean_option(group, "verify", "check for oracle reproducing original passage")
         add_boolean_option(group, "validate-oracle", "require oracle output to respect constraints", default=True)
+        add_boolean_option(group, "check-features", "check differential feature extraction against full extraction")
         add_param_arguments(ap)
 
         group = ap.add_argument_group(title="DyNet parameters")
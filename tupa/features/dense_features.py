@@ -1,6 +1,8 @@
 from collections import OrderedDict
 
-from .feature_extractor import FeatureExtractor, calc
+import numpy as np
+
+from .feature_extractor import FeatureExtractor, TERMINAL_PROP_ATTRS, calc
 from .feature_params import FeatureParameters, NumericFeatureParameters
 from ..model_util import UNKNOWN_VALUE, MISSING_VALUE, UnknownDict, save_dict, load_dict
 
@@ -40,6 +42,54 @@ DEFAULT = ()  # intermediate value for missing features
 FILENAME_SUFFIX = ".enum"
 
 
+class FeatureLayout:
+    """
+    Fixed positions of each feature parameter's values in the arrays of DenseFeatures, computed once from the
+    parameters' slots in the FeaturePlan (not their num, which may differ, e.g. in a model saved by another version):
+    categorical values (indices or embedding ids) in an int32 array, numeric values in a float32 array.
+    Keys are laid out in sorted order, which is the order the classifier consumes them in.
+    """
+    def __init__(self, plan, params, slots_by_key):
+        """
+        :param plan: FeaturePlan to extract the values with
+        :param params: dict of key -> FeatureParameters
+        :param slots_by_key: dict of key -> list of positions in the FeaturePlan's values, for each enabled parameter
+        """
+        self.plan = plan
+        positions = {}
+        sizes = {False: 0, True: 0}  # numeric -> size of array
+        self.keys = []  # (key, numeric, start, end) in sorted key order
+        for key in sorted(slots_by_key):
+            numeric = params[key].numeric
+            start = sizes[numeric]
+            sizes[numeric] = end = start + len(slots_by_key[key]) + numeric  # Numeric values start with the ratio
+            positions[key] = start
+            self.keys.append((key, numeric, start, end))
+        self.steps = [(params[key], positions[key], slots) for key, slots in slots_by_key.items()]  # in params order
+        self.num_indices = sizes[False]
+        self.num_numeric = sizes[True]
+
+
+class DenseFeatures:
+    """
+    Feature values of one parser state, in the arrays laid out by a FeatureLayout.
+    Behaves like the dict returned by DenseFeatureExtractor.extract_features, with items() in sorted key order.
+    """
+    __slots__ = "layout", "indices", "numeric"
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.indices = np.zeros(layout.num_indices, dtype=np.int32)
+        self.numeric = np.zeros(layout.num_numeric, dtype=np.float32)
+
+    def items(self):
+        """
+        :return: generator of (key, array of values) pairs, sorted by key; the arrays are views, not copies
+        """
+        for key, numeric, start, end in self.layout.keys:
+            yield key, (self.numeric if numeric else self.indices)[start:end]
+
+
 class DenseFeatureExtractor(FeatureExtractor):
     """
     Extracts features from the parser state for classification. To be used with a NeuralNetwork classifier.
@@ -60,11 +110,13 @@ class DenseFeatureExtractor(FeatureExtractor):
                 param.node_dropout = self.node_dropout
         else:
             self.params = params
+        self.layout = None  # FeatureLayout, created on first use of extract_arrays
     
     def init_param(self, key):
         param = self.params[key]
         self.update_param_indexed(param)
         param.num = self.num_values()[key]
+        self.layout = None
 
     def num_values(self):
         return {k: len(v) for k, v in self.param_values(all_params=True).items()}
@@ -80,7 +132,9 @@ class DenseFeatureExtractor(FeatureExtractor):
         features = OrderedDict()
         for key, param in self.params.items():
             if param.indexed and param.enabled:
-                values = [calc(n, state, param.prop) for n in state.terminals]
+                attr = TERMINAL_PROP_ATTRS.get(param.prop)
+                values = state.token_attributes[:, attr.value] if attr else [calc(n, state, param.prop)
+                                                                             for n in state.terminals]
                 param.init_data()
                 features[key] = [param.data[v] for v in values]
         return features
@@ -100,7 +154,42 @@ class DenseFeatureExtractor(FeatureExtractor):
                              for v in values]
         return features
 
+    def extract_arrays(self, state):
+        """
+        Calculate feature values according to current state, writing them straight into fixed-layout arrays
+        :param state: current state of the parser
+        :return DenseFeatures with the same values as extract_features, in new arrays (they are kept for updates)
+        """
+        if self.layout is None:
+            plan_key, slots_by_key = self.param_slots()
+            self.layout = FeatureLayout(self.plan(*plan_key), self.params, slots_by_key)
+        values = self.layout.plan.extract(state, DEFAULT, node_dropout=self.node_dropout)
+        features = DenseFeatures(self.layout)
+        for param, start, slots in self.layout.steps:
+            param.init_data()  # Replace categorical values with their values in data dict:
+            if param.numeric:
+                features.numeric[start] = state.node_ratio()
+                features.numeric[start + 1:start + 1 + len(slots)] = [
+                    UNKNOWN_VALUE if values[i] == DEFAULT else values[i] for i in slots]
+            else:
+                features.indices[start:start + len(slots)] = [
+                    MISSING_VALUE if values[i] == DEFAULT else (values[i] if param.indexed else param.data[values[i]])
+                    for i in slots]
+        return features
+
     def param_values(self, state=None, all_params=False):
+        (indexed, hierarchical), slots_by_key = self.param_slots(all_params)
+        plan = self.plan(indexed, hierarchical)
+        values = plan.slots if state is None else plan.extract(state, DEFAULT, node_dropout=self.node_dropout)
+        ratio = [state.node_ratio()] if state else [1] if all_params else []
+        return OrderedDict((key, (ratio if self.params[key].numeric else []) + [values[i] for i in slots])
+                           for key, slots in slots_by_key.items())
+
+    def param_slots(self, all_params=False):
+        """
+        :param all_params: whether to include disabled parameters and ones copied from other parameters
+        :return: pair of (FeaturePlan key, dict of parameter key -> list of the parameter's value positions in the plan)
+        """
         indexed = []
         by_key = OrderedDict()
         by_prop = OrderedDict()
@@ -113,16 +202,13 @@ class DenseFeatureExtractor(FeatureExtractor):
                             continue
                     if param.prop not in indexed:
                         indexed.append(param.prop)  # Only need one copy of indices
-                by_key[key] = by_prop.setdefault(
-                    NumericFeatureParameters.SUFFIX if param.numeric else param.prop,
-                    ([state.node_ratio()] if state else [1] if all_params else []) if param.numeric else [])
-        for e, prop, value in self.feature_template.extract(state, DEFAULT, "".join(indexed), as_tuples=True,
-                                                            node_dropout=self.node_dropout,
-                                                            hierarchical=self.hierarchical):
-            vs = by_prop.get(NumericFeatureParameters.SUFFIX if e.is_numeric(prop) else prop)
-            if vs is not None:
-                vs.append(value if state else (e, prop))
-        return by_key
+                by_key[key] = by_prop.setdefault(NumericFeatureParameters.SUFFIX if param.numeric else param.prop, [])
+        plan_key = ("".join(indexed), self.hierarchical)
+        for i, (e, prop) in enumerate(self.plan(*plan_key).slots):
+            slots = by_prop.get(NumericFeatureParameters.SUFFIX if e.is_numeric(prop) else prop)
+            if slots is not None:
+                slots.append(i)
+        return plan_key, by_key
 
     def all_features(self):
         return ["".join(self.join_props(vs)) for _, vs in sorted(self.param_values().items(), key=lambda x: x[0])]
@@ -155,3 +241,4 @@ class DenseFeatureExtractor(FeatureExtractor):
         super().load(filename, order)
         self.params = FeatureParameters.copy(load_dict(filename + FILENAME_SUFFIX), UnknownDict, order=order)
         self.node_dropout = 0
+        self.layout = None
@@ -1,5 +1,7 @@
 import re
-from ucca import layer0
+from collections import OrderedDict
+from operator import itemgetter
+
 from ucca.layer1 import EdgeTags
 from ucca.textutil import Attr
 
@@ -30,14 +32,6 @@ class FeatureTemplate:
     def __str__(self):
         return self.name
 
-    def extract(self, state, default=None, indexed=(), as_tuples=False, node_dropout=0, hierarchical=False):
-        try:
-            return [value for element in self.elements for value in element.extract(state, default, indexed, as_tuples,
-                                                                                    node_dropout=node_dropout,
-                                                                                    hierarchical=hierarchical)]
-        except ValueError:
-            return None
-
 
 class FeatureTemplateElement:
     """
@@ -106,40 +100,6 @@ class FeatureTemplateElement:
     def __eq__(self, other):
         return self.source == other.source and self.index == other.index and self.relatives == other.relatives
 
-    def set_node(self, state, node_dropout=0):
-        self.node = None
-        if state is None or node_dropout and node_dropout > Config().random.random_sample():
-            return
-        try:
-            if self.source == "s":
-                self.node = state.stack[-1 - self.index]
-            elif self.source == "b":
-                self.node = state.buffer[self.index]
-            else:  # source == "a"
-                self.node = state.actions[-1 - self.index]
-            for relative in self.relatives:
-                nodes = self.node.parents if relative.isupper() else self.node.children
-                if relative.lower() == "r":
-                    if len(nodes) == 1:
-                        raise ValueError("Avoiding identical right and left relatives")
-                    self.node = nodes[-1]
-                else:  # relative.lower() == "l"
-                    self.node = nodes[0]
-        except (IndexError, TypeError, AttributeError, IndexError, ValueError):
-            if Config().args.missing_node_features or node_dropout and node_dropout > Config().random.random_sample():
-                self.node = None
-
-    def extract(self, state, default, indexed, as_tuples, node_dropout=0, hierarchical=False):
-        self.set_node(state, node_dropout=node_dropout)
-        for prop, getter in zip(self.properties, self.getters):
-            if indexed and not self.is_numeric(prop):
-                if prop == indexed[0]:
-                    getter = NODE_PROP_GETTERS["j" if hierarchical else "i"]
-                elif prop in indexed[1:]:
-                    continue
-            value = self.get_prop(state, prop, getter, default)
-            yield (self, prop, value) if as_tuples else value
-
     def get_prop(self, state, prop, getter, default):
         value = calc(self.node, state, prop, getter, self.previous)
         if value is None:
@@ -152,6 +112,188 @@ class FeatureTemplateElement:
         return bool(prop not in NON_NUMERIC or (prop == "d" and self.previous))
 
 
+def resolve_node(state, source, index, relatives):
+    """
+    Find the node (or past action) that feature template elements with the given reference take their values from
+    :return: tuple of (node, whether it could not be fully resolved, in which case it is the last node reached)
+    """
+    node = None
+    try:
+        if source == "s":
+            node = state.stack[-1 - index]
+        elif source == "b":
+            node = state.buffer[index]
+        else:  # source == "a"
+            node = state.actions[-1 - index]
+        for relative in relatives:
+            nodes = node.parents if relative.isupper() else node.children
+            if relative.lower() == "r":
+                if len(nodes) == 1:
+                    raise ValueError("Avoiding identical right and left relatives")
+                node = nodes[-1]
+            else:  # relative.lower() == "l"
+                node = nodes[0]
+    except (IndexError, TypeError, AttributeError, ValueError):
+        return node, True
+    return node, False
+
+
+class FeaturePlan:
+    """
+    Feature templates compiled into a flat list of steps, to extract all their values from a state in one pass:
+    each distinct node reference (s0, b0, s1l etc.) is resolved once, and each value has a fixed position in a buffer.
+    Values are also cached by the nodes they were calculated from, so that the next extraction only recomputes the
+    values of nodes that changed (differential extraction): after most transitions, only a few nodes did.
+    """
+
+    def __init__(self, feature_templates, indexed="", hierarchical=False):
+        """
+        :param feature_templates: FeatureTemplate objects to extract the values of
+        :param indexed: properties to replace by the node index (the first one) or to skip (the rest)
+        :param hierarchical: whether to use the hierarchical node index for the indexed property
+        """
+        references = OrderedDict()  # (source, index, relatives) -> position in self.references
+        shapes = {}  # Getters of a unit of steps -> shape id, the same for units whose values are calculated the same
+        self.templates = []  # (FeatureTemplate, position of its first value, position after its last value, steps)
+        self.units = []  # For each template, list of units of its steps, see create_units()
+        self.slots = []  # (FeatureTemplateElement, property) for each value position
+        for template in feature_templates:
+            start = len(self.slots)
+            steps = []  # (FeatureTemplateElement, reference position, list of (property, getter, value position))
+            for element in template.elements:
+                getters = []
+                for prop, getter in zip(element.properties, element.getters):
+                    if indexed and not element.is_numeric(prop):
+                        if prop == indexed[0]:
+                            getter = NODE_PROP_GETTERS["j" if hierarchical else "i"]
+                        elif prop in indexed[1:]:
+                            continue
+                    getters.append((prop, getter, len(self.slots)))
+                    self.slots.append((element, prop))
+                reference = references.setdefault((element.source, element.index, element.relatives), len(references))
+                steps.append((element, reference, getters))
+            self.templates.append((template, start, len(self.slots), steps))
+            self.units.append(self.create_units(steps, shapes))
+        self.references = list(references)
+        self.values = [None] * len(self.slots)
+        self.cache = {}  # (shape, (node id, node version) per step) -> (nodes, values) for the last extraction
+        self.cache_options = None  # Other arguments the cached values were calculated with
+
+    @staticmethod
+    def create_units(steps, shapes):
+        """
+        Split the steps of a template into units whose values only depend on their own nodes, to be cached separately:
+        each element with properties, together with the previous element if it has binary properties.
+        Separators depend on the whole stack rather than on the node, so they are recomputed even if the rest is cached.
+        :param steps: list of (FeatureTemplateElement, reference position, list of (property, getter, value position))
+        :param shapes: dict of unit getters -> shape id, to look up (or add) the id to use in the unit's cache key
+        :return: list of (position of first value, position after last value, steps, cache key getter or None if
+                          the values are never cached, list of (element, reference, property, getter, value position)
+                          to recompute anyway)
+        """
+        groups = []
+        for step in steps:
+            if step[0].previous is not None and groups:
+                groups[-1].append(step)
+            else:
+                groups.append([step])
+        units = []
+        for group in groups:
+            positions = [i for _, _, getters in group for _, _, i in getters]
+            if positions:
+                volatile = [(e, reference, prop, getter, i) for e, reference, getters in group
+                            for prop, getter, i in getters if prop in "pq"]
+                shape = tuple((e.previous is not None, tuple(g for _, g, _ in getters)) for e, _, getters in group)
+                key = None if any(e.source == "a" for e, _, _ in group) else (  # Actions are not nodes
+                    shapes.setdefault(shape, len(shapes)), itemgetter(*[reference for _, reference, _ in group]))
+                units.append((positions[0], positions[-1] + 1, group, key, volatile))
+        return units
+
+    def extract(self, state, default=None, node_dropout=0):
+        """
+        :param state: current state of the parser, or None to get only default values
+        :param default: value to use for missing values; if None, a template with any missing value is left
+                        incomplete, with None at all its positions
+        :param node_dropout: probability of treating each element's node as missing
+        :return: list of values, one per slot (reused by the next call)
+        """
+        resolved = None if state is None else [resolve_node(state, *reference) for reference in self.references]
+        args = Config().args
+        options = (default, args.missing_node_features)
+        if resolved is None or node_dropout or not args.differential_features:
+            self.cache = {}
+            self._extract(state, resolved, default, node_dropout)
+        else:
+            previous = self.cache if self.cache_options == options else {}
+            self.cache = {}  # Only entries used in this extraction are kept, so the cache does not grow
+            self._extract_differential(state, resolved, default, previous)
+            if args.check_features:
+                values = list(self.values)
+                self._extract(state, resolved, default, node_dropout)
+                assert values == self.values, "Differential feature extraction gave different values: " + ", ".join(
+                    t.name for t, start, end, _ in self.templates if values[start:end] != self.values[start:end])
+        self.cache_options = options
+        return self.values
+
+    def _extract(self, state, resolved, default, node_dropout):
+        missing_node_features = Config().args.missing_node_features
+        random = Config().random.random_sample if node_dropout else None
+        values = self.values
+        for _, start, end, steps in self.templates:
+            try:
+                for element, reference, getters in steps:
+                    element.node = None  # Kept on the element for the getters of the next one to use
+                    if state is not None and not (node_dropout and node_dropout > random()):
+                        node, unresolved = resolved[reference]
+                        if not unresolved or not (missing_node_features or
+                                                  node_dropout and node_dropout > random()):
+                            element.node = node
+                    for prop, getter, i in getters:
+                        values[i] = element.get_prop(state, prop, getter, default)
+            except ValueError:  # Missing value and no default
+                values[start:end] = [None] * (end - start)
+
+    def _extract_differential(self, state, resolved, default, previous):
+        """
+        Like _extract, but take the values of each unit of steps from the previous cache if its nodes did not change.
+        A Node's version changes whenever its edges, label or terminals do, so it is part of the cache key.
+        :param previous: cache of the last extraction
+        """
+        missing_node_features = Config().args.missing_node_features
+        nodes = [None if unresolved and missing_node_features else node for node, unresolved in resolved]
+        keys = [(id(node), getattr(node, "version", None)) for node in nodes]
+        values = self.values
+        for (_, start, end, _), units in zip(self.templates, self.units):
+            try:
+                for unit_start, unit_end, steps, key_getter, volatile in units:
+                    key = cached = None
+                    if key_getter is not None:
+                        key = (key_getter[0], key_getter[1](keys))
+                        cached = previous.get(key)
+                    if cached is None:
+                        unit_values = None  # Unless all values exist (or there is a default)
+                        try:
+                            for element, reference, getters in steps:
+                                element.node = nodes[reference]
+                                for prop, getter, i in getters:
+                                    if prop not in "pq":
+                                        values[i] = element.get_prop(state, prop, getter, default)
+                            unit_values = values[unit_start:unit_end]
+                        finally:
+                            if key is not None:  # Keeping the nodes keeps their ids from being reused
+                                self.cache[key] = ([nodes[reference] for _, reference, _ in steps], unit_values)
+                    else:
+                        self.cache[key] = cached
+                        if cached[1] is None:
+                            raise ValueError("Value does not exist, and no default given")
+                        values[unit_start:unit_end] = cached[1]
+                    for element, reference, prop, getter, i in volatile:
+                        element.node = nodes[reference]
+                        values[i] = element.get_prop(state, prop, getter, default)
+            except ValueError:  # Missing value and no default
+                values[start:end] = [None] * (end - start)
+
+
 class FeatureExtractor:
     """
     Object to extract features from the parser state to be used in action classification
@@ -168,6 +310,16 @@ class FeatureExtractor:
             for feature_name in feature_templates]
         self.params = {} if params is None else params
         self.omit_features = omit_features
+        self.plans = {}  # (indexed, hierarchical) -> FeaturePlan
+
+    def plan(self, indexed="", hierarchical=False):
+        """
+        :return: FeaturePlan compiled from the feature templates on first use
+        """
+        plan = self.plans.get((indexed, hierarchical))
+        if plan is None:
+            plan = self.plans[indexed, hierarchical] = FeaturePlan(self.feature_templates, indexed, hierarchical)
+        return plan
 
     def extract_features(self, state):
         """
@@ -176,6 +328,13 @@ class FeatureExtractor:
         """
         raise NotImplementedError()
 
+    def extract_arrays(self, state):
+        """
+        Calculate feature values according to current state, in the form the classifier takes as input
+        :param state: current state of the parser
+        """
+        return self.extract_features(state)
+
     def init_features(self, state):
         """
         Calculate feature values for initial state
@@ -231,47 +390,44 @@ def height(node, *_):
     return head_terminal_height(node, return_height=True)
 
 
-def static_vars(**kwargs):
-    def decorate(func):
-        for k, v in kwargs.items():
-            setattr(func, k, v)
-        return func
-    return decorate
-
-
 MAX_HEIGHT = 30
 
 
-@static_vars(node=None, head_terminal=None, height=None)
 def head_terminal_height(node, return_height=False):
-    if node is not head_terminal_height.node:
-        head_terminal_height.node = head_terminal_height.head_terminal = node
-        head_terminal_height.height = 0
-        while head_terminal_height.head_terminal.text is None:  # Not a terminal
+    """
+    Follow the highest priority edges from the node to find its head terminal
+    Cached on the node, and invalidated by Node.add_outgoing: the result only depends on the node's own edges
+    :return: the head terminal (or the height, if return_height), or None if not found within MAX_HEIGHT steps
+    """
+    if node.head_terminal_height is None:
+        head_terminal = node
+        height = 0
+        while head_terminal.text is None:  # Not a terminal
             edges = [edge for edge in node.outgoing if not edge.remote and not edge.child.implicit]
-            if not edges or head_terminal_height.height > MAX_HEIGHT:
-                head_terminal_height.head_terminal = head_terminal_height.height = None
+            if not edges or height > MAX_HEIGHT:
+                head_terminal = height = None
                 break
-            head_terminal_height.head_terminal = min(edges, key=lambda edge: EDGE_PRIORITY.get(edge.tag, 0)).child
-            head_terminal_height.height += 1
-    return head_terminal_height.height if return_height else head_terminal_height.head_terminal
+            head_terminal = min(edges, key=lambda edge: EDGE_PRIORITY.get(edge.tag, 0)).child
+            height += 1
+        node.head_terminal_height = head_terminal, height
+    return node.head_terminal_height[1 if return_height else 0]
 
 
 def has_gaps(node, *_):  # Possibly the same as FoundationalNode.discontiguous
-    return any(length > 0 for length in gap_lengths(node))
+    return gap_length_sum(node) > 0
 
 
 def gap_length_sum(node, *_):
-    return sum(gap_lengths(node))
-
-
-def gap_lengths(node, *_):
-    terminals = node.get_terminals()
-    return (t1.index - t2.index - 1 for (t1, t2) in zip(terminals[1:], terminals[:-1]))
+    if not Config().args.gap_features:  # Missing, as for models trained before the gap features were calculated
+        return None
+    first, last, count = node.terminal_span
+    return last - first + 1 - count if count else 0
 
 
 def gap_type(node, *_):
     if node.text is None:  # Not a terminal
+        if not Config().args.gap_features:
+            return None
         if has_gaps(node):
             return 1  # Pass
         if any(child.text is None and has_gaps(child) for child in node.children):
@@ -288,11 +444,14 @@ def dep_distance(node1, node2, *_):
     return None
 
 
-def get_punctuation(nodes, terminals):
+def get_punctuation(nodes, state):
+    """
+    :return: tuple of (number of punctuation terminals between the head terminals of the two nodes, the first of them)
+    """
     if len(nodes) < 2:
         return None
     t0, t1 = sorted([head_terminal(node) for node in nodes], key=lambda t: t.index)
-    return [t for t in terminals[t0.index:t1.index - 1] if t.tag == layer0.NodeTags.Punct]
+    return state.punctuation_between(t0.index, t1.index)
 
 
 ACTION_PROP_GETTERS = {
@@ -301,6 +460,12 @@ ACTION_PROP_GETTERS = {
 }
 
 
+TERMINAL_PROP_ATTRS = {  # Properties that are just token attributes, for terminals
+    "w": Attr.ORTH, "m": Attr.LEMMA, "t": Attr.TAG, "u": Attr.POS, "d": Attr.DEP, "N": Attr.ENT_IOB,
+    "T": Attr.ENT_TYPE, "#": Attr.SHAPE, "^": Attr.PREFIX, "$": Attr.SUFFIX,
+}
+
+
 NODE_PROP_GETTERS = {
     "w": lambda node, *_: head_terminal(node).tok[Attr.ORTH.value],
     "m": lambda node, *_: head_terminal(node).tok[Attr.LEMMA.value],
@@ -329,8 +494,8 @@ NODE_PROP_GETTERS = {
 
 
 SEP_PROP_GETTERS = {
-    "p": lambda nodes, terminals: get_punctuation(nodes, terminals)[0].tok[Attr.ORTH.value],
-    "q": lambda nodes, terminals: len(get_punctuation(nodes, terminals)),
+    "p": lambda nodes, state: get_punctuation(nodes, state)[1].tok[Attr.ORTH.value],
+    "q": lambda nodes, state: get_punctuation(nodes, state)[0],
 }
 
 
@@ -345,7 +510,7 @@ def calc(node, state, prop=None, getter=None, prev=None):
         getter = prop_getter(prop)
     try:
         if prop in "pq":
-            return getter(state.stack[-1:-3:-1], state.terminals)
+            return getter(state.stack[-1:-3:-1], state)
         return getter(node, None if prev is None else prev.node, prev is not None)
     except (TypeError, AttributeError, IndexError, StopIteration):
         return None
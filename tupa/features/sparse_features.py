@@ -1,3 +1,6 @@
+import hashlib
+from functools import lru_cache
+
 from .feature_extractor import FeatureExtractor
 
 FEATURE_TEMPLATES = (
@@ -39,6 +42,24 @@ FEATURE_TEMPLATES = (
     # NER
     "s0NT", "s1NT", "b0NT", "b1NT",
 )
+HASH_MASK = (1 << 64) - 1
+HASH_PRIME = 0x100000001b3  # 64-bit FNV prime, for combining the hashes of a feature's template and values
+VALUE_ID_CACHE_SIZE = 1 << 16  # Number of feature value ids to keep, as the same values keep occurring
+
+
+def stable_hash(value):
+    """
+    :return: 64-bit hash of the value's string form, the same in every process (unlike the built-in hash of a str)
+    """
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "little")
+
+
+@lru_cache(maxsize=VALUE_ID_CACHE_SIZE, typed=True)
+def value_id(value):
+    """
+    :return: stable hash of a feature value, cached by its type too, since equal values (True and 1) differ in str
+    """
+    return stable_hash(value)
 
 
 class SparseFeatureExtractor(FeatureExtractor):
@@ -47,21 +68,62 @@ class SparseFeatureExtractor(FeatureExtractor):
     To be used with SparsePerceptron classifier.
     """
 
-    def __init__(self, omit_features=None):
+    def __init__(self, omit_features=None, hashing=False, table_size=0):
+        """
+        :param omit_features: string of feature properties to omit
+        :param hashing: whether to identify features by integer ids hashed from the template and values, not strings
+        :param table_size: if hashing, number of ids to fold the hashes into (0 for full 64-bit ids)
+        """
         super().__init__(feature_templates=FEATURE_TEMPLATES, omit_features=omit_features)
+        self.hashing = hashing
+        self.table_size = table_size
+        self.template_ids = [stable_hash(t.name) for t in self.feature_templates]  # Aligned with plan().templates
+        self.bias_id, self.ratio_id = map(stable_hash, ("b", "n/t"))
 
     def extract_features(self, state):
         """
         Calculate feature values according to current state
         :param state: current state of the parser
-        :return dict of feature name -> value
+        :return dict of feature name (or integer id, if hashing) -> value
         """
+        if self.hashing:
+            return self.extract_feature_ids(state)
         features = {
             "b": 1,  # Bias
             "n/t": state.node_ratio(),  # number of nodes divided by number of terminals
         }
-        for feature_template in self.feature_templates:
-            values = feature_template.extract(state)
-            if values:
-                features["%s=%s" % (feature_template.name, " ".join(map(str, values)))] = 1
+        plan = self.plan()
+        values = plan.extract(state)
+        for feature_template, start, end, _ in plan.templates:
+            if end > start and values[start] is not None:
+                features["%s=%s" % (feature_template.name, " ".join(map(str, values[start:end])))] = 1
         return features
+
+    def extract_feature_ids(self, state):
+        """
+        Like extract_features, but identify each feature by a stable hash of its template name and values, instead
+        of formatting them into a string. Values are hashed by their string form, so the ids match the feature strings.
+        With a table size, features whose ids are folded into the same one share it, with the sum of their values.
+        :param state: current state of the parser
+        :return dict of feature id -> value
+        """
+        features = {self.bias_id: 1, self.ratio_id: state.node_ratio()}
+        plan = self.plan()
+        values = plan.extract(state)
+        for feature_id, (_, start, end, _) in zip(self.template_ids, plan.templates):
+            if end > start and values[start] is not None:
+                for value in values[start:end]:  # Masked once at the end: the lower 64 bits do not depend on the rest
+                    feature_id = (feature_id ^ value_id(value)) * HASH_PRIME
+                features[feature_id & HASH_MASK] = 1  # Like feature strings, the same feature is counted once
+        return self.fold(features) if self.table_size else features
+
+    def fold(self, features):
+        """
+        :param features: dict of 64-bit feature id -> value
+        :return: dict of feature id bounded by the table size -> sum of the values of the features folded into it
+        """
+        folded = {}
+        for feature_id, value in features.items():
+            feature_id %= self.table_size
+            folded[feature_id] = folded.get(feature_id, 0) + value
+        return folded
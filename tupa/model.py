@@ -1,14 +1,17 @@
 from collections import OrderedDict
 from enum import Enum
 
+import numpy as np
+
 from ucca import textutil
 from ucca.layer0 import Terminal
 
-from .action import Actions
+from .action import Action, Actions
 from .classifiers.classifier import Classifier
 from .config import Config, SEPARATOR, SPARSE, MLP, BIRNN, HIGHWAY_RNN, HIERARCHICAL_RNN, NOOP
 from .features.feature_params import FeatureParameters
 from .model_util import UnknownDict, AutoIncrementDict, remove_backup, save_json, load_json
+from .timing import NO_TIMES
 
 
 class ParameterDefinition:
@@ -74,10 +77,18 @@ class ParameterDefinition:
 NODE_LABEL_KEY = "n"
 
 
+def label_key(label):
+    """
+    :return: key identifying the label across models (action IDs are specific to each model)
+    """
+    return (label.type_id, label.tag) if isinstance(label, Action) else label
+
+
 class ClassifierProperty(Enum):
     update_only_on_error = 1
     require_init_features = 2
     trainable_after_saving = 3
+    stateful_transitions = 4
 
 
 CLASSIFIER_PROPERTIES = {
@@ -85,7 +96,8 @@ CLASSIFIER_PROPERTIES = {
     MLP: (ClassifierProperty.trainable_after_saving,),
     BIRNN: (ClassifierProperty.trainable_after_saving, ClassifierProperty.require_init_features),
     HIGHWAY_RNN: (ClassifierProperty.trainable_after_saving, ClassifierProperty.require_init_features),
-    HIERARCHICAL_RNN: (ClassifierProperty.trainable_after_saving, ClassifierProperty.require_init_features),
+    HIERARCHICAL_RNN: (ClassifierProperty.trainable_after_saving, ClassifierProperty.require_init_features,
+                       ClassifierProperty.stateful_transitions),
     NOOP: (ClassifierProperty.trainable_after_saving,),
 }
 
@@ -120,6 +132,7 @@ class Model:
         self.feature_extractor = self.classifier = self.axis = self.lang = None
         self.feature_params = OrderedDict()
         self.is_finalized = False
+        self.label_alignments = {}  # axis -> (key, index), see aligned_scores()
         if args or kwargs:
             self.restore(*args, **kwargs)
 
@@ -155,7 +168,9 @@ class Model:
         elif self.config.args.classifier == SPARSE:
             from .features.sparse_features import SparseFeatureExtractor
             from .classifiers.linear.sparse_perceptron import SparsePerceptron
-            self.feature_extractor = SparseFeatureExtractor(omit_features=self.config.args.omit_features)
+            self.feature_extractor = SparseFeatureExtractor(omit_features=self.config.args.omit_features,
+                                                            hashing=self.config.args.feature_hashing,
+                                                            table_size=self.config.args.feature_table_size)
             self.classifier = SparsePerceptron(self.config, labels)
         elif self.config.args.classifier == NOOP:
             from .features.empty_features import EmptyFeatureExtractor
@@ -224,9 +239,37 @@ class Model:
         node_labels.init_data()
         return node_labels.data
 
-    def score(self, state, axis):
-        features = self.feature_extractor.extract_features(state)
-        return self.classifier.score(features, axis=axis), features  # scores is a NumPy array
+    def score(self, state, axis, times=NO_TIMES):
+        with times("features"):
+            features = self.feature_extractor.extract_arrays(state)
+        with times("scoring"):
+            return self.classifier.score(features, axis=axis), features  # scores is a NumPy array
+
+    def score_batch(self, states, axis, times=NO_TIMES):
+        with times("features"):
+            features = [self.feature_extractor.extract_arrays(state) for state in states]
+        with times("scoring"):
+            return list(zip(self.classifier.score_batch(features, axis=axis), features))
+
+    def aligned_scores(self, scores, axis, labels):
+        """
+        Reorder this model's scores to match the label order of another model, for ensembles
+        :param scores: NumPy array of scores for this model's labels in the given axis
+        :param axis: axis of the label we are predicting
+        :param labels: list of labels (of the other model) to align to
+        :return: NumPy array with the score for each of labels, 0 for labels unknown to this model
+        """
+        own = self.classifier.labels[axis].all
+        key = (id(own), len(own), id(labels), len(labels))  # Recalculated only when labels are added
+        cached_key, index = self.label_alignments.get(axis, (None, None))
+        if cached_key != key:
+            positions = {label_key(label): i for i, label in enumerate(own)}
+            index = np.fromiter((positions.get(label_key(label), len(own)) for label in labels),
+                                dtype=int, count=len(labels))
+            self.label_alignments[axis] = (key, index)
+        padded = np.zeros(len(own) + 1)  # Last entry is for missing labels
+        padded[:len(scores)] = scores
+        return padded[index]
 
     def init_features(self, state, train):
         self.init_model()
@@ -290,6 +333,10 @@ class Model:
                 self.config.args.classifier = Classifier.get_property(self.filename, "type")
                 self.config.args.multilingual = Classifier.get_property(self.filename, "multilingual")
                 self.config.args.omit_features = Classifier.get_property(self.filename, "omit_features")
+                if self.config.args.classifier == SPARSE:  # Models saved before feature hashing used feature strings
+                    self.config.args.feature_hashing = bool(Classifier.get_property(self.filename, "feature_hashing"))
+                    self.config.args.feature_table_size = Classifier.get_property(self.filename,
+                                                                                  "feature_table_size") or 0
                 self.config.args.use_bert = Classifier.get_property(self.filename, "use_bert")
                 if self.config.args.use_bert:
                     self.config.args.bert_model = Classifier.get_property(self.filename, "bert_model")
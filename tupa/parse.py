@@ -1,12 +1,17 @@
-import concurrent.futures
+import heapq
+import multiprocessing
 import os
 import sys
 import time
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from enum import Enum
 from functools import partial
 from glob import glob
+from itertools import count, islice
+from operator import itemgetter
+from types import SimpleNamespace
 
+import numpy as np
 from semstr.convert import FROM_FORMAT, TO_FORMAT, from_text
 from semstr.evaluate import EVALUATORS, Scores
 from semstr.util.amr import LABEL_ATTRIB, WIKIFIER
@@ -17,10 +22,13 @@ from ucca.evaluation import LABELED, UNLABELED, EVAL_TYPES, evaluate as evaluate
 from ucca.normalization import normalize
 
 from tupa.__version__ import GIT_VERSION
+from tupa.action_stats import ActionStats
 from tupa.config import Config, Iterations
 from tupa.model import Model, NODE_LABEL_KEY, ClassifierProperty
 from tupa.oracle import Oracle
+from tupa.pipeline import Stage, Sink
 from tupa.states.state import State
+from tupa.timing import PhaseTimes, NO_TIMES, write_times
 from tupa.traceutil import set_traceback_listener
 
 
@@ -28,6 +36,10 @@ class ParserException(Exception):
     pass
 
 
+class ParserTimeout(ParserException):
+    pass
+
+
 class ParseMode(Enum):
     train = 1
     dev = 2
@@ -41,7 +53,9 @@ class AbstractParser:
         self.training = training
         self.evaluation = evaluation
         self.action_count = self.correct_action_count = self.label_count = self.correct_label_count = \
-            self.num_tokens = self.f1 = 0
+            self.forced_action_count = self.num_tokens = self.f1 = 0
+        self.times = PhaseTimes() if self.config.args.timing else NO_TIMES  # Seconds and calls per parsing phase
+        self.action_stats = ActionStats() if self.config.args.action_stats else None  # Action counts, if requested
         self.started = time.time()
 
     @property
@@ -81,7 +95,14 @@ class PassageParser(AbstractParser):
         # Used in verify_passage to optionally ignore a mismatch in linkage nodes:
         self.ignore_node = None if self.config.args.linkage else lambda n: n.tag == layer1.NodeTags.Linkage
         self.state_hash_history = set()
-        self.state = self.oracle = self.eval_type = None
+        if self.action_stats is not None:  # Also keeps the rows of the CSV file until the passage is finished
+            self.action_stats.filename = self.config.args.action_stats
+        self.state = self.oracle = self.eval_type = self.transitions = self.status = None
+
+    @property
+    def axis_key(self):
+        """ Passages with the same key are parsed by the same classifier axis """
+        return self.in_format, self.lang if self.config.args.multilingual else None
 
     def init(self):
         self.config.set_format(self.in_format)
@@ -97,22 +118,25 @@ class PassageParser(AbstractParser):
             model.init_model(self.config.format, lang=self.lang if self.config.args.multilingual else None)
             if ClassifierProperty.require_init_features in model.classifier_properties:
                 model.init_features(self.state, self.training)
+        self.started = time.time()  # The --timeout deadline is for the transitions, not for initialization
 
     def parse(self, display=True, write=False, accuracies=None):
         self.init()
         passage_id = self.passage.ID
         try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                executor.submit(self.parse_internal).result(self.config.args.timeout)
+            if self.beam:
+                self.parse_beam()
+            else:
+                self.parse_internal()
             status = "(%d tokens/s)" % self.tokens_per_second()
+        except ParserTimeout as e:
+            self.config.log("%s %s: %s" % (self.config.passage_word, passage_id, e))
+            status = "(timeout)"
         except ParserException as e:
             if self.training:
                 raise
             self.config.log("%s %s: %s" % (self.config.passage_word, passage_id, e))
             status = "(failed)"
-        except concurrent.futures.TimeoutError:
-            self.config.log("%s %s: timeout (%fs)" % (self.config.passage_word, passage_id, self.config.args.timeout))
-            status = "(timeout)"
         return self.finish(status, display=display, write=write, accuracies=accuracies)
 
     def parse_internal(self):
@@ -120,21 +144,199 @@ class PassageParser(AbstractParser):
         Internal method to parse a single passage.
         If training, use oracle to train on given passages. Otherwise just parse with classifier.
         """
+        transitions = self.generate_transitions()
+        try:
+            axis = next(transitions)
+            while True:
+                axis = transitions.send(self.model.score(self.state, axis, self.times))
+        except StopIteration:
+            pass
+
+    @property
+    def beam(self):
+        return self.config.args.beam > 1 and not self.training and not self.config.args.use_gold_node_labels and \
+            not any(ClassifierProperty.stateful_transitions in model.classifier_properties for model in self.models)
+
+    def parse_beam(self):
+        """
+        Parse with beam search (see search_beam), and then continue greedily if the chosen state is not finished
+        """
+        try:
+            self.state = self.search_beam()
+        finally:  # Also if failed or timed out, as generate_transitions counts the transitions made so far
+            self.count_transitions()
+        if not self.state.finished:
+            self.parse_internal()
+
+    def search_beam(self):
+        """
+        Beam search, keeping the --beam highest-scoring states after each transition, for up to --beam-steps of them.
+        The states in the beam are scored in one batch, and each is expanded by its best valid actions.
+        A state is forked only if more than one of its expansions is kept, and is otherwise advanced in place.
+        Node labels are chosen greedily per state, and their scores are added to the state's.
+        Finished states stay in the beam, competing with the expansions of the others, until the best state is finished.
+        If no state in the beam has a valid action, the best finished state seen so far is chosen.
+        :return: the chosen state, with the shares of all other states released (see State.release)
+        """
+        width = self.config.args.beam
+        actions = self.model.actions.all
+
+        def expand(score, state, scores):  # Generator of (total score, state, action), by descending total score
+            return ((score + scores[i], state, actions[i]) for i in scores.argsort()[::-1])
+
+        beam = [(0, self.state)]  # List of (total score, state), sorted by descending score
+        best_finished = None  # (total score, state) of the best finished state, even after it has left the beam
+        for _ in range(self.config.args.beam_steps) if self.config.args.beam_steps else count():
+            beam = self.label_states(beam)
+            self.state = beam[0][1]  # Best so far, to be output in case of timeout
+            self.check_timeout()
+            if self.state.finished:
+                break
+            finished = [(score, state, None) for score, state in beam if state.finished]
+            unfinished = [(score, state) for score, state in beam if not state.finished]
+            if finished and (best_finished is None or finished[0][0] > best_finished[0]):
+                if best_finished is not None and all(best_finished[1] is not state for _, state in beam):
+                    best_finished[1].release()
+                best_finished = finished[0][:2]
+            candidates = list(islice(filter(lambda c: c[2] is None or c[1].is_valid_action(c[2]), heapq.merge(
+                finished, *[expand(score, state, scores) for (score, state), scores in
+                            zip(unfinished, self.score_states([state for _, state in unfinished], self.model.axis))],
+                key=itemgetter(0), reverse=True)), width))  # Lazily, to check validity only of the best candidates
+            if not candidates:
+                if best_finished is None:
+                    raise ParserException("No valid action available in beam")
+                candidates = [best_finished + (None,)]
+            expansions = Counter(id(state) for _, state, _ in candidates)
+            for _, state in beam:  # Dropped states give up their shares, so that the others need not copy them
+                if not (expansions[id(state)] or best_finished and state is best_finished[1]):
+                    state.release()
+            beam = []
+            for score, state, action in candidates:
+                if action is not None:
+                    expansions[id(state)] -= 1
+                    with self.times("transition"):
+                        if expansions[id(state)]:  # Not the last expansion of this state, so keep the original intact
+                            state = state.fork()
+                        state.transition(action)
+                beam.append((score, state))
+            for model in self.models:
+                model.classifier.finished_step(self.training)
+        if best_finished is not None and best_finished[0] > beam[0][0]:  # Scores only decrease, so it stays better
+            beam.insert(0, best_finished)
+        for state in {id(state): state for _, state in beam[1:] + [best_finished or beam[0]]}.values():
+            if state is not beam[0][1]:
+                state.release()
+        return beam[0][1]
+
+    def score_states(self, states, axis):
+        """
+        Score states in one batch per model, adding the scores of any other ensemble members to the first's
+        :return: list of score vectors, aligned to the labels of the first model, as log probabilities: so that the
+                 total scores of states decrease with each transition, and finished states can be compared to the rest
+        """
+        if not states:
+            return []
+        all_scores = [scores for scores, _ in self.model.score_batch(states, axis, self.times)]
+        labels = self.model.classifier.labels[axis].all
+        for model in self.models[1:]:
+            for scores, (model_scores, _) in zip(all_scores, model.score_batch(states, axis, self.times)):
+                scores += model.aligned_scores(model_scores, axis, labels)
+        return list(map(log_softmax, all_scores))
+
+    def label_states(self, beam):
+        """
+        Label the node of each state in the beam that needs a label, by its best valid label
+        :param beam: list of (total score, state)
+        :return: list of (total score, state) with the labels' scores added, sorted by descending score
+        """
+        states = [state for _, state in beam if state.need_label]
+        if not states:
+            return beam
+        label_scores = {}  # id of state -> score of its chosen label
+        labels = self.model.classifier.labels[NODE_LABEL_KEY].all
+        for state, scores in zip(states, self.score_states(states, NODE_LABEL_KEY)):
+            with self.times("validity"):
+                label = self.predict(scores, labels, partial(state.valid_labels_mask, labels), state.is_valid_label,
+                                     "node label")
+            label_scores[id(state)] = scores[labels.index(label)]
+            with self.times("transition"):
+                state.label_node(label)
+        return sorted(((score + label_scores.get(id(state), 0), state) for score, state in beam), key=itemgetter(0),
+                      reverse=True)
+
+    def count_transitions(self):
+        """
+        Count the actions and labels of the state chosen by beam search, as choose() does for each greedy transition.
+        The oracle follows a single sequence of states, so they are replayed on a new state to get the true ones.
+        """
+        state = self.state
+        self.state = State(self.passage)
+        for action in [None] + state.actions:  # In case root node needs labeling
+            if action is not None:
+                true_actions = self.get_true_actions()
+                self.correct_action_count += action.id in true_actions
+                self.action_count += 1
+                if self.action_stats is not None:
+                    self.action_stats.add(self.in_format, action, action, list(true_actions.values()))
+                self.state.transition(true_actions.get(action.id, action))  # Oracle's instance, so it is updated
+            if self.state.need_label:
+                true_label, _ = self.get_true_label(action or self.state.need_label)
+                label = state.nodes[self.state.need_label.index].label
+                self.correct_label_count += bool(self.oracle) and label == true_label
+                self.label_count += 1
+                self.state.label_node(label)
+        self.state = state
+
+    def check_timeout(self):
+        if self.config.args.timeout and not self.training and self.duration > self.config.args.timeout:
+            raise ParserTimeout("timeout (%fs)" % self.config.args.timeout)
+
+    def start(self):
+        """
+        Initialize parsing of the passage without running it, to be advanced by resume() together with other passages
+        :return: axis the classifier should score the state by next, or None if parsing has already ended
+        """
+        self.init()
+        self.transitions = self.generate_transitions()
+        return self.resume()
+
+    def resume(self, scores=None):
+        """
+        Continue parsing until the classifier needs to score the state again, or until parsing ends
+        :param scores: pair of (scores, features) for the state, as returned by Model.score
+        :return: axis the classifier should score the state by next, or None if parsing has ended (see self.status)
+        """
+        try:
+            return self.transitions.send(scores)
+        except StopIteration:
+            self.status = "(%d tokens/s)" % self.tokens_per_second()
+        except ParserTimeout as e:
+            self.config.log("%s %s: %s" % (self.config.passage_word, self.passage.ID, e))
+            self.status = "(timeout)"
+        except ParserException as e:
+            self.config.log("%s %s: %s" % (self.config.passage_word, self.passage.ID, e))
+            self.status = "(failed)"
+        return None
+
+    def generate_transitions(self):
+        """
+        Apply transitions to the state until it is finished.
+        Whenever the classifier is needed, yield the axis to score by, and expect to be sent Model.score's result.
+        If --timeout has passed, stop between transitions, leaving the state partial (it is still turned to a passage).
+        """
         self.config.print("  initial state: %s" % self.state)
         while True:
+            self.check_timeout()
             if self.config.args.check_loops:
                 self.check_loop()
-            self.label_node()  # In case root node needs labeling
+            yield from self.label_node()  # In case root node needs labeling
             true_actions = self.get_true_actions()
-            action, predicted_action = self.choose(true_actions)
-            self.state.transition(action)
-            need_label, label, predicted_label, true_label = self.label_node(action)
-            if self.config.args.action_stats:
-                try:
-                    with open(self.config.args.action_stats, "a") as f:
-                        print(",".join(map(str, [predicted_action, action] + list(true_actions.values()))), file=f)
-                except OSError:
-                    pass
+            action, predicted_action = yield from self.choose(true_actions)
+            with self.times("transition"):
+                self.state.transition(action)
+            need_label, label, predicted_label, true_label = yield from self.label_node(action)
+            if self.action_stats is not None:
+                self.action_stats.add(self.in_format, predicted_action, action, list(true_actions.values()))
             self.config.print(lambda: "\n".join(["  predicted: %-15s true: %-15s taken: %-15s %s" % (
                 predicted_action, "|".join(map(str, true_actions.values())), action, self.state) if self.oracle else
                                           "  action: %-15s %s" % (action, self.state)] + (
@@ -148,7 +350,8 @@ class PassageParser(AbstractParser):
         true_actions = {}
         if self.oracle:
             try:
-                true_actions = self.oracle.get_actions(self.state, self.model.actions, create=self.training)
+                with self.times("oracle"):
+                    true_actions = self.oracle.get_actions(self.state, self.model.actions, create=self.training)
             except (AttributeError, AssertionError) as e:
                 if self.training:
                     raise ParserException("Error in getting action from oracle during training") from e
@@ -156,7 +359,8 @@ class PassageParser(AbstractParser):
 
     def get_true_label(self, node):
         try:
-            return self.oracle.get_label(self.state, node) if self.oracle else (None, None)
+            with self.times("oracle"):
+                return self.oracle.get_label(self.state, node) if self.oracle else (None, None)
         except AssertionError as e:
             if self.training:
                 raise ParserException("Error in getting label from oracle during training") from e
@@ -167,8 +371,9 @@ class PassageParser(AbstractParser):
         need_label = self.state.need_label  # Label action that requires a choice of label
         if need_label:
             true_label, raw_true_label = self.get_true_label(action or need_label)
-            label, predicted_label = self.choose(true_label, NODE_LABEL_KEY, "node label")
-            self.state.label_node(raw_true_label if label == true_label else label)
+            label, predicted_label = yield from self.choose(true_label, NODE_LABEL_KEY, "node label")
+            with self.times("transition"):
+                self.state.label_node(raw_true_label if label == true_label else label)
         return need_label, label, predicted_label, true_label
 
     def choose(self, true, axis=None, name="action"):
@@ -177,21 +382,30 @@ class PassageParser(AbstractParser):
         elif axis == NODE_LABEL_KEY and self.config.args.use_gold_node_labels:
             return true, true
         labels = self.model.classifier.labels[axis]
+        forced = None  # Index of the only valid action, if there is one
         if axis == NODE_LABEL_KEY:
             true_keys = (labels[true],) if self.oracle else ()  # Must be before score()
             is_valid = self.state.is_valid_label
+            valid_mask = partial(self.state.valid_labels_mask, labels.all)
         else:
             true_keys = None
             is_valid = self.state.is_valid_action
-        scores, features = self.model.score(self.state, axis)
-        for model in self.models[1:]:  # Ensemble if given more than one model; align label order and add scores
-            label_scores = dict(zip(model.classifier.labels[axis].all, self.model.score(self.state, axis)[0]))
-            scores += [label_scores.get(a, 0) for a in labels.all]  # Product of Experts, assuming log(softmax)
-        self.config.print(lambda: "  %s scores: %s" % (name, tuple(zip(labels.all, scores))), level=4)
-        try:
-            label = pred = self.predict(scores, labels.all, is_valid)
-        except StopIteration as e:
-            raise ParserException("No valid %s available\n%s" % (name, self.oracle.log if self.oracle else "")) from e
+            valid_mask = partial(self.state.valid_actions_mask, labels)
+            if not self.training:  # Skip the classifier if only one action is valid
+                with self.times("validity"):
+                    forced = self.state.single_valid_action(labels)
+        if forced is not None:
+            scores = features = None
+            label = pred = labels.all[forced]
+            self.forced_action_count += 1
+        else:
+            scores, features = yield axis  # Scored by whoever drives the parsing, see parse_internal()
+            for model in self.models[1:]:  # Ensemble if given more than one model; align label order and add scores
+                model_scores, _ = model.score(self.state, axis, self.times)
+                scores += model.aligned_scores(model_scores, axis, labels.all)  # Product of Experts
+            self.config.print(lambda: "  %s scores: %s" % (name, tuple(zip(labels.all, scores))), level=4)
+            with self.times("validity"):
+                label = pred = self.predict(scores, labels.all, valid_mask, is_valid, name)
         label, is_correct, true_keys, true_values = self.correct(axis, label, pred, scores, true, true_keys)
         if self.training:
             if not (is_correct and ClassifierProperty.update_only_on_error in self.model.classifier_properties):
@@ -228,41 +442,48 @@ class PassageParser(AbstractParser):
             self.action_count += 1
         return label, is_correct, true_keys, true_values
 
-    @staticmethod
-    def predict(scores, values, is_valid=None):
+    def predict(self, scores, values, valid_mask, is_valid=None, name="action"):
         """
         Choose action/label based on classifier
         Usually the best action/label is valid, so max is enough to choose it in O(n) time
-        Otherwise, sorts all the other scores to choose the best valid one in O(n lg n)
+        Otherwise, masks out all invalid ones at once, to choose the best valid one in O(n) time too
+        :param valid_mask: boolean array marking which of all values are valid, or function returning it, to be called
+                           only if the best value is not valid according to is_valid
+        :param is_valid: function checking whether a single value is valid, if valid_mask is a function
         :return: valid action/label with maximum probability according to classifier
         """
-        return next(filter(is_valid, (values[i] for i in PassageParser.generate_descending(scores))))
-
-    @staticmethod
-    def generate_descending(scores):
-        yield scores.argmax()
-        yield from scores.argsort()[::-1]  # Contains the max, but otherwise items might be missed (different order)
+        best = scores.argmax()
+        if callable(valid_mask):
+            if is_valid(values[best]):
+                return values[best]
+            valid_mask = valid_mask()
+        valid_mask = valid_mask[:len(scores)]
+        if not valid_mask[best]:
+            if not valid_mask.any():
+                raise ParserException("No valid %s available\n%s" % (name, self.oracle.log if self.oracle else ""))
+            best = np.where(valid_mask, scores, -np.inf).argmax()
+        return values[best]
 
     def finish(self, status, display=True, write=False, accuracies=None):
+        if self.action_stats is not None:
+            self.action_stats.flush()
         self.model.classifier.finished_item(self.training)
         for model in self.models[1:]:
             model.classifier.finished_item(renew=False)  # So that dynet.renew_cg happens only once
         if not self.training or self.config.args.verify:
-            self.out = self.state.create_passage(verify=self.config.args.verify, format=self.out_format)
+            with self.times("passage"):
+                self.out = self.state.create_passage(verify=self.config.args.verify, format=self.out_format)
         if write:
-            for out_format in self.config.args.formats or [self.out_format]:
-                if self.config.args.normalize and out_format == "ucca":
-                    normalize(self.out)
-                ioutil.write_passage(self.out, output_format=out_format, binary=out_format == "pickle",
-                                     outdir=self.config.args.outdir, prefix=self.config.args.prefix,
-                                     converter=get_output_converter(out_format), verbose=self.config.args.verbose,
-                                     append=self.config.args.join, basename=self.config.args.join)
+            with self.times("write"):
+                (write_output if write is True else write)(
+                    self.out, self.config.args.formats or [self.out_format], self.config.args)
         if self.oracle and self.config.args.verify:
             self.verify(self.out, self.passage)
         ret = (self.out,)
         if self.evaluation:
             ret += (self.evaluate(self.evaluation),)
             status = "%-14s %s F1=%.3f" % (status, self.eval_type, self.f1)
+        self.status = status
         if display:
             self.config.print("%s%.3fs %s" % (self.accuracy_str, self.duration, status), level=1)
         if accuracies is not None:
@@ -324,37 +545,60 @@ class BatchParser(AbstractParser):
         super().__init__(*args, **kwargs)
         self.seen_per_format = defaultdict(int)
         self.num_passages = 0
+        self.stage_waits = None  # Stage name -> seconds spent waiting for input and for output, if pipelined
+        self.passage_times = OrderedDict()  # Passage ID -> PhaseTimes, if --timing
 
     def parse(self, passages, display=True, write=False, accuracies=None):
         passages, total = generate_and_len(single_to_iter(passages))
         if self.config.args.ignore_case:
             passages = to_lower_case(passages)
-        pr_width = len(str(total))
-        id_width = 1
         if self.config.args.use_bert:
             passages = filter_passages_for_bert(passages, self.config.args)
-        passages = self.add_progress_bar(textutil.annotate_all(
+        read = annotate = sink = None
+        if self.pipelined:  # Read in a separate thread
+            passages = read = Stage("read", passages, maxsize=self.config.args.pipeline_queue_size)
+        passages = textutil.annotate_all(
             passages, as_array=True, as_extra=False, lang=self.config.args.lang, verbose=self.config.args.verbose > 2,
-            vocab=self.model.config.vocab(lang=self.config.args.lang)), display=display)
+            vocab=self.model.config.vocab(lang=self.config.args.lang))
+        if self.pipelined:  # Annotate and write in separate threads too, parsing in this one
+            passages = annotate = Stage("annotate", passages, maxsize=self.config.args.pipeline_queue_size)
+            if write:
+                sink = Sink("write", write_formats, maxsize=self.config.args.pipeline_queue_size)
+                write = partial(write_output, write=sink.put)
+        if self.parallel:
+            yield from self.parse_parallel(passages, total, display=display, write=write)
+        elif self.lockstep:
+            yield from self.parse_lockstep(self.add_progress_bar(passages, display=display), total, display=display,
+                                           write=write, accuracies=accuracies)
+        else:
+            yield from self.parse_sequential(self.add_progress_bar(passages, display=display), total,
+                                             display=display, write=write, accuracies=accuracies)
+        if sink is not None:
+            sink.close()
+        if self.pipelined:
+            self.stage_waits = OrderedDict((
+                ("read", (None, read.output_wait)),
+                ("annotate", (read.consumer_wait, annotate.output_wait)),
+                ("parse", (annotate.consumer_wait, sink and sink.producer_wait)),
+                ("write", (sink and sink.input_wait, None)),
+            ))
+        if self.times and self.config.args.testscores and not self.training and \
+                self.evaluation is not ParseMode.dev:
+            write_times(os.path.splitext(self.config.args.testscores)[0] + ".timing.json", self.times,
+                        self.passage_times)
+        if self.num_passages and display:
+            self.summary()
+
+    @property
+    def pipelined(self):
+        return self.config.args.pipeline and not self.training
+
+    def parse_sequential(self, passages, total, display=True, write=False, accuracies=None):
+        pr_width = len(str(total))
+        id_width = 1
         for i, passage in enumerate(passages, start=1):
             parser = PassageParser(passage, self.config, self.models, self.training, self.evaluation)
-            if self.config.args.verbose and display:
-                progress = "%3d%% %*d/%d" % (i / total * 100, pr_width, i, total) if total and i <= total else "%d" % i
-                id_width = max(id_width, len(str(passage.ID)))
-                print("%s %2s %-6s %-*s" % (progress, parser.lang, parser.in_format, id_width, passage.ID),
-                      end=self.config.line_end)
-            else:
-                passages.set_description()
-                postfix = {parser.lang + " " + parser.in_format: passage.ID}
-                if display:
-                    postfix["|t/s|"] = self.tokens_per_second()
-                    if self.correct_action_count:
-                        postfix["|a|"] = percents_str(self.correct_action_count, self.action_count, fraction=False)
-                    if self.correct_label_count:
-                        postfix["|l|"] = percents_str(self.correct_label_count, self.label_count, fraction=False)
-                    if self.evaluation and self.num_passages:
-                        postfix["|F1|"] = self.f1 / self.num_passages
-                passages.set_postfix(**postfix)
+            id_width = self.show_progress(passages, parser, i, total, pr_width, id_width, display=display)
             self.seen_per_format[parser.in_format] += 1
             if self.training and self.config.args.max_training_per_format and \
                     self.seen_per_format[parser.in_format] > self.config.args.max_training_per_format:
@@ -363,8 +607,113 @@ class BatchParser(AbstractParser):
             assert not (self.training and parser.in_format == "text"), "Cannot train on unannotated plain text"
             yield parser.parse(display=display, write=write, accuracies=accuracies)
             self.update_counts(parser)
-        if self.num_passages and display:
-            self.summary()
+
+    @property
+    def lockstep(self):
+        return self.config.args.batch_size > 1 and self.config.args.beam == 1 and not self.training and not any(
+            ClassifierProperty.require_init_features in model.classifier_properties for model in self.models)
+
+    def parse_lockstep(self, passages, total, display=True, write=False, accuracies=None):
+        """
+        Parse up to --batch-size passages at a time, advancing them together one transition at a time, so that the
+        classifier scores the states of all of them in one batch per step.
+        Finished passages are replaced by the next ones, as long as they share the classifier axis with the rest.
+        Results are yielded in input order.
+        """
+        pr_width = len(str(total))
+        id_width = 1
+        parsers = ((i, PassageParser(passage, self.config, self.models, self.training, self.evaluation))
+                   for i, passage in enumerate(passages, start=1))
+        pending = next(parsers, None)
+        active = []  # List of (input index, PassageParser, axis to score by next)
+        finished = {}  # Input index -> parse result, waiting for previous passages to finish
+        next_index = 1
+        while pending or active:
+            while pending and len(active) < self.config.args.batch_size and (
+                    not active or pending[1].axis_key == active[0][1].axis_key):
+                i, parser = pending
+                active.append((i, parser, parser.start()))
+                pending = next(parsers, None)
+            by_axis = defaultdict(list)
+            for i, parser, axis in active:
+                if axis is not None:
+                    by_axis[axis].append((i, parser))
+            axes = {}
+            for axis, axis_parsers in by_axis.items():
+                for (i, parser), scores in zip(axis_parsers, self.model.score_batch(
+                        [parser.state for _, parser in axis_parsers], axis, self.times)):
+                    axes[i] = parser.resume(scores)
+            still_active = []
+            for i, parser, axis in active:
+                axis = axes.get(i, axis)
+                if axis is None:
+                    id_width = self.show_progress(passages, parser, i, total, pr_width, id_width, display=display)
+                    self.seen_per_format[parser.in_format] += 1
+                    finished[i] = parser.finish(parser.status, display=display, write=write, accuracies=accuracies)
+                    self.update_counts(parser)
+                else:
+                    still_active.append((i, parser, axis))
+            active = still_active
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    @property
+    def parallel(self):
+        return self.config.args.workers > 1 and not self.training
+
+    def parse_parallel(self, passages, total, display=True, write=False):
+        """
+        Parse passages in --workers processes, forked after the models are loaded, so each has its own copy of them.
+        All passages are read first, and handed out longest-first so that no worker is left with a long one at the end.
+        Results are yielded in input order, and written by this process, so that --join output is in order too.
+        So are the rows of --action-stats, which the workers keep for this process rather than writing them.
+        """
+        pr_width = len(str(total))
+        id_width = 1
+        passages = list(passages)
+        order = sorted(range(len(passages)), key=lambda i: -len(passages[i].layer(layer0.LAYER_ID).all))
+        if self.action_stats is not None:
+            self.action_stats.filename = self.config.args.action_stats
+        with multiprocessing.get_context("fork").Pool(self.config.args.workers, initializer=init_worker,
+                                                      initargs=(self,)) as pool:
+            results = self.add_progress_bar(in_input_order(pool.imap_unordered(
+                parse_in_worker, ((i, passages[i]) for i in order))), total=len(passages), display=display)
+            for i, (ret, info) in enumerate(results, start=1):
+                info.passage = passages[i - 1]
+                id_width = self.show_progress(results, info, i, total, pr_width, id_width, display=display)
+                self.seen_per_format[info.in_format] += 1
+                if write:
+                    with self.times("write"):
+                        (write_output if write is True else write)(
+                            ret[0], self.config.args.formats or [info.out_format], self.config.args)
+                if display:
+                    self.config.print("%s%.3fs %s" % (info.accuracy_str, info.duration, info.status), level=1)
+                self.update_counts(info)
+                yield ret
+        if self.action_stats is not None:
+            self.action_stats.flush()
+
+    def show_progress(self, passages, parser, i, total, pr_width, id_width, display=True):
+        passage = parser.passage
+        if self.config.args.verbose and display:
+            progress = "%3d%% %*d/%d" % (i / total * 100, pr_width, i, total) if total and i <= total else "%d" % i
+            id_width = max(id_width, len(str(passage.ID)))
+            print("%s %2s %-6s %-*s" % (progress, parser.lang, parser.in_format, id_width, passage.ID),
+                  end=self.config.line_end)
+        else:
+            passages.set_description()
+            postfix = {parser.lang + " " + parser.in_format: passage.ID}
+            if display:
+                postfix["|t/s|"] = self.tokens_per_second()
+                if self.correct_action_count:
+                    postfix["|a|"] = percents_str(self.correct_action_count, self.action_count, fraction=False)
+                if self.correct_label_count:
+                    postfix["|l|"] = percents_str(self.correct_label_count, self.label_count, fraction=False)
+                if self.evaluation and self.num_passages:
+                    postfix["|F1|"] = self.f1 / self.num_passages
+            passages.set_postfix(**postfix)
+        return id_width
 
     def add_progress_bar(self, it, total=None, display=True):
         return it if self.config.args.verbose and display else tqdm(
@@ -375,9 +724,15 @@ class BatchParser(AbstractParser):
         self.action_count += parser.action_count
         self.correct_label_count += parser.correct_label_count
         self.label_count += parser.label_count
+        self.forced_action_count += parser.forced_action_count
         self.num_tokens += parser.num_tokens
         self.num_passages += 1
         self.f1 += parser.f1
+        if self.action_stats is not None:
+            self.action_stats.update(parser.action_stats)
+        if self.times:
+            self.times.update(parser.times)
+            self.passage_times[parser.passage.ID] = parser.times
 
     def summary(self):
         print("Parsed %d%s" % (self.num_passages, self.config.passages_word))
@@ -386,6 +741,15 @@ class BatchParser(AbstractParser):
             if self.label_count:
                 accuracy_str += ", " + percents_str(self.correct_label_count, self.label_count, "correct labels ")
             print("Overall %s" % accuracy_str)
+        if self.forced_action_count:
+            print("Skipped classifier for %s" % percents_str(self.forced_action_count, self.action_count,
+                                                              "actions that were the only valid ones "))
+        if self.stage_waits:
+            print("Waiting time per stage (for input/output): " + ", ".join(
+                "%s %s/%s" % (stage, *["%.3fs" % t if t is not None else "-" for t in waits])
+                for stage, waits in self.stage_waits.items()))
+        if self.times:
+            print("Time per phase (calls): %s" % self.times)
         print("Total time: %.3fs (average time/%s: %.3fs, average tokens/s: %d)" % (
             self.duration, self.config.passage_word, self.time_per_passage(),
             self.tokens_per_second()), flush=True)
@@ -396,11 +760,12 @@ class BatchParser(AbstractParser):
 
 class Parser(AbstractParser):
     """ Main class to implement transition-based UCCA parser """
-    def __init__(self, model_files=(), config=None, beam=1):
+    def __init__(self, model_files=(), config=None, beam=None):
         super().__init__(config=config or Config(),
                          models=list(map(Model, (model_files,) if isinstance(model_files, str) else
                                          model_files or (config.args.classifier,))))
-        self.beam = beam  # Currently unused
+        if beam is not None:
+            self.config.args.beam = beam  # Used by PassageParser.parse_beam
         self.best_score = self.dev = self.test = self.iteration = self.epoch = self.batch = None
         self.trained = self.save_init = False
         self.accuracies = {}
@@ -534,6 +899,8 @@ class Parser(AbstractParser):
                 self.eval_and_save()
                 self.batch += 1
             yield passage
+        if self.action_stats is not None:
+            self.action_stats.update(parser.action_stats)
 
     def print_config(self):
         self.config.print("tupa %s" % (self.model.config if self.model else self.config), level=0)
@@ -570,12 +937,76 @@ def train_test(train_passages, dev_passages, test_passages, args, model_suffix="
             yield scores
 
 
+def write_output(passage, out_formats, args, write=None):
+    """
+    Write parsed passage to file(s), normalizing it first if requested
+    :param write: function to do the writing with after normalization, with the same arguments (default: write_formats)
+    """
+    if args.normalize and "ucca" in out_formats:
+        normalize(passage)
+    (write or write_formats)(passage, out_formats, args)
+
+
+def write_formats(passage, out_formats, args):
+    for out_format in out_formats:
+        ioutil.write_passage(passage, output_format=out_format, binary=out_format == "pickle", outdir=args.outdir,
+                             prefix=args.prefix, converter=get_output_converter(out_format), verbose=args.verbose,
+                             append=args.join, basename=args.join)
+
+
+WORKER_BATCH_PARSER = None  # Set in each process of BatchParser.parse_parallel's pool
+
+
+def init_worker(batch_parser):
+    global WORKER_BATCH_PARSER
+    WORKER_BATCH_PARSER = batch_parser
+
+
+def parse_in_worker(item):
+    """
+    Parse one passage in a worker process of BatchParser.parse_parallel
+    :param item: pair of (input index, passage)
+    :return: triple of (input index, parse result, namespace of what the main process needs to report and count)
+    """
+    i, passage = item
+    parser = PassageParser(passage, WORKER_BATCH_PARSER.config, WORKER_BATCH_PARSER.models,
+                           WORKER_BATCH_PARSER.training, WORKER_BATCH_PARSER.evaluation)
+    if parser.action_stats is not None:  # Returned with the counts, so that only the main process writes the rows
+        parser.action_stats.keep_rows = True
+    ret = parser.parse(display=False)
+    return i, ret, SimpleNamespace(
+        lang=parser.lang, in_format=parser.in_format, out_format=parser.out_format, status=parser.status,
+        accuracy_str=parser.accuracy_str, duration=parser.duration, num_tokens=parser.num_tokens, f1=parser.f1,
+        action_count=parser.action_count, correct_action_count=parser.correct_action_count,
+        label_count=parser.label_count, correct_label_count=parser.correct_label_count,
+        forced_action_count=parser.forced_action_count, times=parser.times, action_stats=parser.action_stats)
+
+
+def in_input_order(results):
+    """
+    :param results: iterable of (input index, *result) in any order, with indices starting from 0
+    :return: generator of result tuples, in input order
+    """
+    finished = {}
+    next_index = 0
+    for i, *result in results:
+        finished[i] = result
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+
 def get_output_converter(out_format, default=None):
     converter = TO_FORMAT.get(out_format)
     return partial(converter, wikification=Config().args.wikification,
                    verbose=Config().args.verbose > 2) if converter else default
 
 
+def log_softmax(scores):
+    scores = scores - scores.max()
+    return scores - np.log(np.exp(scores).sum())
+
+
 def percents_str(part, total, infix="", fraction=True):
     ret = "%d%%" % (100 * part / total)
     if fraction:
@@ -0,0 +1,91 @@
+import time
+from queue import Queue
+from threading import Thread
+
+END = object()  # Marks the end of the items passed through a queue
+
+
+class Stage:
+    """
+    Pipeline stage consuming an iterable in a worker thread, and passing its items on through a bounded queue.
+    Iterating over the stage (in the next stage's thread) yields the items in the same order.
+    :param name: name of the stage, for reporting
+    :param items: iterable to consume, usually a generator doing the stage's work on the items of a previous stage
+    :param maxsize: maximum number of items waiting in the queue
+    """
+    def __init__(self, name, items, maxsize=1):
+        self.name = name
+        self.items = items
+        self.queue = Queue(maxsize)
+        self.output_wait = 0  # Seconds spent waiting for the next stage to take items
+        self.consumer_wait = 0  # Seconds the next stage spent waiting for items from this one
+        self.error = None
+        self.thread = Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for item in self.items:
+                started = time.time()
+                self.queue.put(item)
+                self.output_wait += time.time() - started
+        except Exception as e:  # To be raised in the consuming thread
+            self.error = e
+        finally:
+            self.queue.put(END)
+
+    def __iter__(self):
+        while True:
+            started = time.time()
+            item = self.queue.get()
+            self.consumer_wait += time.time() - started
+            if item is END:
+                break
+            yield item
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class Sink:
+    """
+    Last pipeline stage, applying a function to the items put into it, in a worker thread
+    :param name: name of the stage, for reporting
+    :param func: function to apply to the arguments given to put()
+    :param maxsize: maximum number of items waiting in the queue
+    """
+    def __init__(self, name, func, maxsize=1):
+        self.name = name
+        self.func = func
+        self.queue = Queue(maxsize)
+        self.input_wait = 0  # Seconds spent waiting for items to be put
+        self.producer_wait = 0  # Seconds the previous stage spent waiting for this one to take items
+        self.error = None
+        self.thread = Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            started = time.time()
+            item = self.queue.get()
+            self.input_wait += time.time() - started
+            if item is END:
+                break
+            if self.error is None:  # After an error, keep taking items so that the producer does not block
+                try:
+                    self.func(*item)
+                except Exception as e:  # To be raised in the producing thread
+                    self.error = e
+
+    def put(self, *args):
+        if self.error is not None:
+            raise self.error
+        started = time.time()
+        self.queue.put(args)
+        self.producer_wait += time.time() - started
+
+    def close(self):
+        self.queue.put(END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import timeit
+from functools import partial
+
+from ucca.convert import from_text
+
+from tupa.action import Actions
+from tupa.config import Config
+from tupa.states.node import Node
+from tupa.states.state import State
+
+desc = """Measure the time of parser state operations as the passage length grows."""
+
+ACTIONS = [Actions.Shift, Actions.Reduce, Actions.Swap, Actions.Node("A"), Actions.Implicit("A"),
+           Actions.LeftEdge("A"), Actions.RightEdge("A"), Actions.LeftRemote("A"), Actions.RightRemote("A")]
+
+
+def build_state(length, seed=1):
+    """
+    :param length: number of tokens in the passage
+    :param seed: for choosing the actions
+    :return: State after applying random valid actions until the buffer is empty
+    """
+    passage = next(from_text(list(map(str, range(length))), tokenized=True))
+    state = State(passage)
+    rnd = random.Random(seed)
+    while state.buffer:
+        valid = [action for action in ACTIONS if state.is_valid_action(action)]
+        if not valid:
+            break
+        state.transition(rnd.choice(valid)())
+    return state
+
+
+def fork(state):
+    state.fork()
+
+
+def fork_and_reduce(state):
+    state.fork().transition(Actions.Reduce())
+
+
+def topological_sort(state):
+    Node.topological_sort(state.nodes)
+
+
+def create_passage(state):
+    state.fork().create_passage(verify=False)  # The fork's nodes are linked to the passage's, keep the original clean
+
+
+BENCHMARKS = {
+    "fork": fork,
+    "fork_and_reduce": fork_and_reduce,
+    "hash": hash,
+    "topological_sort": topological_sort,
+    "create_passage": create_passage,
+}
+
+
+def main(args):
+    Config("--max-action-ratio", "1000", "--max-node-ratio", "1000", "--max-height", "1000")  # Not from sys.argv
+    print("%-20s %8s %8s %14s" % ("benchmark", "tokens", "nodes", "usec/call"))
+    for name in args.benchmarks:
+        for length in args.lengths:
+            state = build_state(length)
+            timer = timeit.Timer(partial(BENCHMARKS[name], state))
+            number = args.number or timer.autorange()[0]
+            seconds = min(timer.repeat(repeat=3, number=number))
+            print("%-20s %8d %8d %14.2f" % (name, length, len(state.nodes), 1e6 * seconds / number))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description=desc)
+    argparser.add_argument("-l", "--lengths", nargs="+", type=int, default=(10, 100, 1000, 5000, 10000),
+                           help="passage lengths (in tokens) to measure with")
+    argparser.add_argument("-b", "--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                           help="operations to measure")
+    argparser.add_argument("-n", "--number", type=int, help="number of calls per measurement (default: at least 0.2s)")
+    main(argparser.parse_args())
@@ -0,0 +1,48 @@
+from semstr.constraints import Constraints
+from semstr.validation import CONSTRAINTS
+
+
+class ConstraintTables:
+    """
+    A format's Constraints object, compiled into lookup tables for validity checking.
+    Whether a tag rule is violated by a new edge depends only on the edge's tag and direction, and on the tags of the
+    edges the node already has. So the rules are evaluated once per such combination, and then looked up.
+    The allow_* checks depend on more than edge tags, so they are only kept if the format overrides the defaults.
+    """
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self.violated_rules = {}  # (tag, direction, incoming tags, outgoing tags) -> first violated TagRule, or None
+        self.allow_parent, self.allow_child, self.allow_edge = [
+            None if getattr(type(constraints), name) is getattr(Constraints, name) else getattr(constraints, name)
+            for name in ("allow_parent", "allow_child", "allow_edge")]
+
+    def violated_rule(self, node, tag, direction):
+        """
+        :param node: Node getting a new edge
+        :param tag: tag of the new edge
+        :param direction: semstr.constraints.Direction of the new edge with respect to the node
+        :return: the first of the constraints' tag rules violated by adding the edge, or None if there is none
+        """
+        key = (tag, direction, frozenset(node.incoming_tags), frozenset(node.outgoing_tags))
+        try:
+            return self.violated_rules[key]
+        except KeyError:
+            rule = self.violated_rules[key] = next((rule for rule in self.constraints.tag_rules
+                                                    if rule.violation(node, tag, direction) is not None), None)
+            return rule
+
+
+TABLES = {}  # (format, implicit) -> ConstraintTables, shared by all states
+
+
+def constraint_tables(passage_format, implicit=False):
+    """
+    :param passage_format: format of the passage being parsed, to choose the constraints by
+    :param implicit: whether implicit nodes are allowed
+    :return: ConstraintTables for the format, created once and then kept for all passages of that format
+    """
+    key = (passage_format, implicit)
+    tables = TABLES.get(key)
+    if tables is None:
+        tables = TABLES[key] = ConstraintTables(CONSTRAINTS.get(passage_format, Constraints)(implicit=implicit))
+    return tables
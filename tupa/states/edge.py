@@ -5,18 +5,25 @@ class Edge:
     """
     Temporary representation for core.Edge with only relevant information for parsing
     """
+    __slots__ = ("parent", "child", "tag", "remote")
+
     def __init__(self, parent, child, tag, remote=False):
         self.parent = parent  # Node object from which this edge comes
         self.child = child  # Node object to which this edge goes
         self.tag = tag  # String tag
         self.remote = remote  # True or False
 
+    def fork(self, parent, child):
+        """
+        Copy of the edge between the given (forked) nodes, without adding it to them
+        """
+        return Edge(parent, child, self.tag, remote=self.remote)
+
     def add(self):
         assert self.parent is not self.child, "Trying to create self-loop edge on %s" % self.parent
         if Config().args.verify:
             assert self not in self.parent.outgoing, "Trying to create outgoing edge twice: %s" % self
             assert self not in self.child.incoming, "Trying to create incoming edge twice: %s" % self
-            assert self.parent not in self.child.descendants, "Detected cycle created by edge: %s" % self
         self.parent.add_outgoing(self)
         self.child.add_incoming(self)
 
@@ -29,7 +36,7 @@ class Edge:
                                   " (remote)" if self.remote else "")
 
     def __eq__(self, other):
-        return other and self.parent.index == other.parent.index and self.child == other.child and \
+        return other and self.parent.index == other.parent.index and self.child.index == other.child.index and \
                self.tag == other.tag and self.remote == other.remote
 
     def __hash__(self):
@@ -1,6 +1,6 @@
+import copy
 from collections import deque
 
-from operator import attrgetter
 from semstr.util.amr import LABEL_ATTRIB, UNKNOWN_LABEL, LABEL_SEPARATOR
 from ucca import core, layer0
 from ucca.layer1 import EdgeTags
@@ -12,6 +12,11 @@ class Node:
     """
     Temporary representation for core.Node with only relevant information for parsing
     """
+    __slots__ = ("index", "orig_node", "node_id", "text", "paragraph", "tag", "label", "category", "labeled",
+                 "node_index", "outgoing", "incoming", "children", "parents", "outgoing_tags", "incoming_tags", "node",
+                 "implicit", "swap_index", "height", "terminal_bits", "head_terminal_height", "tok", "version",
+                 "is_root", "root")
+
     def __init__(self, index, swap_index=None, orig_node=None, text=None, paragraph=None, tag=None, label=None,
                  implicit=False, is_root=False, root=None):
         self.index = index  # Index in the configuration's node list
@@ -39,7 +44,11 @@ class Node:
         self.implicit = implicit  # True or False
         self.swap_index = self.index if swap_index is None else swap_index  # To avoid swapping nodes more than once
         self.height = 0
-        self._terminals = None
+        # Bitset of the indices of all terminals under the node by primary edges, kept up to date by State.add_edge:
+        self.terminal_bits = 0 if text is None else 1 << index
+        self.head_terminal_height = None  # Cache for features.feature_extractor.head_terminal_height
+        self.tok = None  # For terminals, row of State.token_attributes: attribute values by ucca.textutil.Attr
+        self.version = 0  # Incremented on any change that features may depend on, see FeaturePlan.extract
         self.is_root = is_root
         self.root = root  # Original Passage object this belongs to
 
@@ -47,13 +56,25 @@ class Node:
         self.incoming.append(edge)
         self.parents.append(edge.parent)
         self.incoming_tags.add(edge.tag)
+        self.version += 1
 
     def add_outgoing(self, edge):
         self.outgoing.append(edge)
         self.children.append(edge.child)
         self.outgoing_tags.add(edge.tag)
         self.height = max(self.height, edge.child.height + 1)
-        self._terminals = None  # Invalidate terminals because we might have added some
+        self.head_terminal_height = None  # The new edge might be the head edge
+        self.version += 1
+
+    def fork(self):
+        """
+        Shallow copy of the node, to be used by State.fork, which replaces the edges and nodes it points to
+        """
+        node = copy.copy(self)
+        node.outgoing_tags = set(self.outgoing_tags)
+        node.incoming_tags = set(self.incoming_tags)
+        node.head_terminal_height = None  # Points to the original nodes
+        return node
 
     @staticmethod
     def attach_nodes(l0, l1, nodes, labeled=True, node_labels=False, verify=False):
@@ -78,33 +99,33 @@ class Node:
         """
         Sort self.nodes topologically, each node appearing as early as possible
         Also sort each node's outgoing and incoming edge according to the node order
+        Runs in linear time: each node's level is set once, after those of all its parents, by a depth-first search
+        upwards from the leaves, and positions are looked up in a dict rather than searched for in the list
         """
         levels = {}
         level_by_index = {}
-        stack = [node for node in nodes if not node.outgoing]
-        while stack:
-            node = stack.pop()
-            if node.index not in level_by_index:
-                parents = [edge.parent for edge in node.incoming]
-                if parents:
-                    unexplored_parents = [parent for parent in parents
-                                          if parent.index not in level_by_index]
-                    if unexplored_parents:
-                        for parent in unexplored_parents:
-                            stack.append(node)
-                            stack.append(parent)
-                    else:
-                        level = 1 + max(level_by_index[parent.index] for parent in parents)
-                        levels.setdefault(level, []).append(node)
-                        level_by_index[node.index] = level
-                else:
-                    levels.setdefault(0, []).append(node)
-                    level_by_index[node.index] = 0
+        for leaf in reversed([node for node in nodes if not node.outgoing]):
+            if leaf.index in level_by_index:
+                continue
+            stack = [(leaf, reversed(leaf.incoming))]  # Nodes on the current path, with their parents left to visit
+            while stack:
+                node, incoming = stack[-1]
+                for edge in incoming:
+                    if edge.parent.index not in level_by_index:
+                        stack.append((edge.parent, reversed(edge.parent.incoming)))
+                        break
+                else:  # All parents have levels already
+                    stack.pop()
+                    level = 1 + max(level_by_index[edge.parent.index] for edge in node.incoming) \
+                        if node.incoming else 0
+                    levels.setdefault(level, []).append(node)
+                    level_by_index[node.index] = level
         nodes = [node for level, level_nodes in sorted(levels.items())
                  for node in sorted(level_nodes, key=lambda x: x.node_index or x.index)]
+        positions = {node.index: i for i, node in enumerate(nodes)}
         for node in nodes:
-            node.outgoing.sort(key=lambda x: x.child.node_index or nodes.index(x.child))
-            node.incoming.sort(key=lambda x: x.parent.node_index or nodes.index(x.parent))
+            node.outgoing.sort(key=lambda x: x.child.node_index or positions[x.child.index])
+            node.incoming.sort(key=lambda x: x.parent.node_index or positions[x.parent.index])
         return nodes
 
     def add_to_l1(self, l0, l1, parent, tag, labeled, node_labels):
@@ -213,21 +234,13 @@ class Node:
         return result
 
     @property
-    def terminals(self):
-        if self._terminals is None:
-            q = [self]
-            terminals = []
-            while q:
-                n = q.pop()
-                q.extend(n.children)
-                if n.text is not None:
-                    terminals.append(n)
-            self._terminals = sorted(terminals, key=attrgetter("index"))
-        return self._terminals
-
-    @property
-    def tok(self):
-        return self.orig_node.tok
+    def terminal_span(self):
+        """
+        :return: tuple of (first terminal index, last terminal index, number of terminals) of the terminals under the
+                 node, found from its terminal bitset without walking the graph; all 0 if there are none
+        """
+        bits = self.terminal_bits
+        return ((bits & -bits).bit_length() - 1, bits.bit_length() - 1, bin(bits).count("1")) if bits else (0, 0, 0)
 
     def __repr__(self):
         return Node.__name__ + "(" + str(self.index) + \
@@ -244,7 +257,7 @@ class Node:
         return self.index == other.index and self.outgoing == other.outgoing
 
     def __hash__(self):
-        return hash((self.index, tuple(self.outgoing)))
+        return hash(self.index)
 
     def __iter__(self):
         return iter(self.outgoing)
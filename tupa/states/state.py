@@ -1,18 +1,116 @@
+import copy
+import heapq
 from collections import deque
+from contextlib import contextmanager
 
-from semstr.constraints import Constraints, Direction
+import numpy as np
+from semstr.constraints import Direction
 from semstr.util.amr import LABEL_ATTRIB
-from semstr.validation import CONSTRAINTS
 from ucca import core, layer0, layer1
 from ucca.layer0 import NodeTags
 from ucca.layer1 import EdgeTags
+from ucca.textutil import Attr
 
+from .constraint_tables import constraint_tables
 from .edge import Edge
 from .node import Node
 from ..action import Actions
 from ..config import Config
 
 
+def bit_indices(bits):
+    """
+    :param bits: int used as a bitset
+    :return: generator of the indices of the set bits
+    """
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class UnsortedList(list):
+    """
+    List whose sort() does nothing, to stand in for a layer's node lists while it is built in bulk
+    """
+    def sort(self, *args, **kwargs):
+        pass
+
+
+class UnsortedNodeList(UnsortedList):
+    """
+    UnsortedList of a layer's nodes, which also keeps the edge lists of each node appended to it unsorted
+    """
+    def append(self, node):
+        super().append(node)
+        unsort_edges(node)
+
+
+def unsort_edges(node):
+    node._outgoing, node._incoming = UnsortedList(node._outgoing), UnsortedList(node._incoming)
+
+
+@contextmanager
+def bulk_creation(*layers):
+    """
+    core.Layer re-sorts all its nodes after every node or edge added, which makes building a passage quadratic.
+    So does core.Node with its edges, and layer1.Layer1 checks the parent of every edge added for being a top-level
+    scene, looking through all of its children, which is quadratic in the number of children of a node.
+    Within this context, nodes and edges are kept in the order they were added in, and each layer is sorted once on
+    exit, along with the edges of its nodes. Top-level scenes and linkages are then found once, from the final graph.
+    :param layers: core.Layer objects to add nodes and edges to
+    """
+    for layer in layers:
+        for node in layer._all:
+            unsort_edges(node)
+        layer._all, layer._heads = UnsortedNodeList(layer._all), UnsortedList(layer._heads)
+        if isinstance(layer, layer1.Layer1):
+            layer._update_edge = lambda edge: None
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer._all, layer._heads = [sorted(nodes, key=layer._orderkey) for nodes in (layer._all, layer._heads)]
+            for node in layer._all:
+                node._outgoing, node._incoming = [sorted(edges, key=node._orderkey)
+                                                  for edges in (node._outgoing, node._incoming)]
+            if isinstance(layer, layer1.Layer1):
+                del layer._update_edge
+                for node in layer._all:
+                    layer._update_top_scene(node)
+                for node in layer._all:
+                    if node.tag == layer1.NodeTags.Linkage:
+                        layer._update_top_linkage(node)
+
+
+HASH_MODULUS = (1 << 61) - 1  # For the polynomial hashes of the stack and buffer
+HASH_BASE = 1000003
+HASH_POWERS = [1]  # HASH_BASE ** i % HASH_MODULUS, extended as needed
+
+
+def position_hash(node, position):
+    """
+    :return: hash of a node at a given position in a sequence, to be summed modulo HASH_MODULUS
+    """
+    while len(HASH_POWERS) <= position:
+        HASH_POWERS.append(HASH_POWERS[-1] * HASH_BASE % HASH_MODULUS)
+    return (node.index + 1) * HASH_POWERS[position]
+
+
+def sequence_hash(nodes):
+    """
+    :return: polynomial hash of a sequence of nodes, where the first is at position 0
+    """
+    return sum(position_hash(node, i) for i, node in enumerate(nodes)) % HASH_MODULUS
+
+
+def edge_hash(edge):
+    """
+    :return: hash of an edge, to be XORed with the other edges' for a hash of the whole graph
+    """
+    return hash((edge.parent.index, edge.child.index, edge.tag))
+
+
 class InvalidActionError(AssertionError):
     def __init__(self, *args, is_type=False):
         super().__init__(*args)
@@ -26,7 +124,8 @@ class State:
     """
     def __init__(self, passage):
         self.args = Config().args
-        self.constraints = CONSTRAINTS.get(passage.extra.get("format"), Constraints)(implicit=self.args.implicit)
+        self.constraint_tables = constraint_tables(passage.extra.get("format"), self.args.implicit)
+        self.constraints = self.constraint_tables.constraints
         self.log = []
         self.finished = False
         self.passage = passage
@@ -41,17 +140,120 @@ class State:
         self.labeled = any(n.outgoing or n.attrib.get(LABEL_ATTRIB) for n in l1.all)
         self.terminals = [Node(i, orig_node=t, root=passage, text=t.text, paragraph=t.paragraph, tag=t.tag)
                           for i, t in enumerate(l0.all, start=1)]
+        # Terminal position -> spaCy attribute values, by Attr, looked up in the passage once instead of by every feature.
+        # Values are kept as they are (int IDs that may not fit in int64, or None), hence the object dtype:
+        self.token_attributes = np.full((len(self.terminals), len(Attr)), None, dtype=object)
+        for terminal, row in zip(self.terminals, self.token_attributes):
+            tok = terminal.orig_node.tok
+            if tok is not None:
+                row[:len(tok)] = tok[:len(Attr)]
+            terminal.tok = row
+        self.punctuation_counts = [0]  # Terminal index -> number of punctuation terminals up to and including it
+        for terminal in self.terminals:
+            self.punctuation_counts.append(self.punctuation_counts[-1] + (terminal.tag == NodeTags.Punct))
+        self.next_punctuation = [None] * (len(self.terminals) + 2)  # Terminal index -> first punctuation index from it
+        for terminal in reversed(self.terminals):
+            self.next_punctuation[terminal.index] = terminal.index if terminal.tag == NodeTags.Punct else \
+                self.next_punctuation[terminal.index + 1]
         self.stack = []
         self.buffer = deque()
         self.nodes = []
+        self.descendants = []  # Node index -> bitset of the indices of the node and all its descendants
+        self.ancestors = []  # Node index -> bitset of the indices of the node and all its ancestors
         self.heads = set()
+        self.head_heights = []  # Heap of (-height, node index) for heads, with the tallest current head on top
+        self.unlabeled = 0  # Number of non-terminals without a label
+        self.non_terminals = 0  # Number of non-terminals other than the root and linkage nodes
+        self.parentless = 0  # Number of those non-terminals without any incoming edge
         self.need_label = None  # If we are waiting for label_node() to be called, which node is to be labeled by it
         self.root = self.add_node(orig_node=l1.heads[0], is_root=True)  # Root is not in the buffer
         self.stack.append(self.root)
         self.buffer += self.terminals
+        self.stack_hash, self.buffer_hash, self.edges_hash = self.calculate_hashes()  # Kept up to date by transition()
         self.nodes += self.terminals
+        self.descendants += [1 << terminal.index for terminal in self.terminals]
+        self.ancestors += [1 << terminal.index for terminal in self.terminals]
         self.actions = []  # History of applied actions
         self.type_validity_cache = {}
+        self._shares = {part: [1] for part in ("graph", "sequence", "history")}  # Reference counts, see fork()
+
+    def fork(self):
+        """
+        Copy the state in constant time, so that the copy can be advanced separately, e.g. by beam search.
+        The graph, stack, buffer and history remain shared until either state changes them, which copies them first.
+        The passage, constraints and node attributes are shared with this state anyway.
+        :return: new State equal to this one
+        """
+        state = copy.copy(self)
+        state._shares = dict(self._shares)
+        for refs in self._shares.values():
+            refs[0] += 1
+        return state
+
+    def release(self):
+        """
+        Give up the parts still shared with other states by fork(), when this state is discarded (e.g. by beam search),
+        so that they can change them without copying them first. This state must not be used afterwards.
+        """
+        for refs in self._shares.values():
+            refs[0] -= 1
+        self._shares = {}
+
+    def _own(self, part):
+        """
+        Copy part of the state if it is still shared with another state by fork(), before changing it
+        :param part: "graph" (nodes, edges, and the stack and buffer referring to them), "sequence" (stack and buffer)
+                     or "history" (actions and log)
+        :return: whether a copy was made
+        """
+        refs = self._shares[part]
+        if refs[0] == 1:
+            return False
+        refs[0] -= 1
+        self._shares[part] = [1]
+        if part == "graph":
+            self._own("sequence")
+            self._copy_graph()
+        elif part == "sequence":
+            self.stack = list(self.stack)
+            self.buffer = deque(self.buffer)
+        else:
+            self.actions = list(self.actions)
+            self.log = list(self.log)
+        return True
+
+    def _copy_graph(self):
+        nodes = self.nodes
+        self.nodes = [node.fork() for node in nodes]
+        edges = {}  # id of original edge -> copied edge
+        for node in self.nodes:
+            node.outgoing = [edge.fork(node, self.nodes[edge.child.index]) for edge in node.outgoing]
+            edges.update(zip(map(id, nodes[node.index].outgoing), node.outgoing))
+        for node in self.nodes:
+            node.incoming = [edges[id(edge)] for edge in node.incoming]
+            node.children = [self.nodes[child.index] for child in node.children]
+            node.parents = [self.nodes[parent.index] for parent in node.parents]
+        self.terminals = self.nodes[1:len(self.terminals) + 1]
+        self.root = self.nodes[self.root.index]
+        self.stack = [self.nodes[node.index] for node in self.stack]
+        self.buffer = deque(self.nodes[node.index] for node in self.buffer)
+        self.heads = {self.nodes[node.index] for node in self.heads}
+        if self.need_label is not None:
+            self.need_label = self.nodes[self.need_label.index]
+        self.descendants = list(self.descendants)
+        self.ancestors = list(self.ancestors)
+        self.head_heights = list(self.head_heights)
+
+    def _count(self, node, sign):
+        """
+        Add (sign=1) or remove (sign=-1) the node's contribution to the counters checked before FINISH and REDUCE,
+        so that they can be updated in constant time around any change to the node
+        """
+        if node.text is None:
+            self.unlabeled += sign * (not node.labeled)
+            if not node.is_root and not node.is_linkage:
+                self.non_terminals += sign
+                self.parentless += sign * (not node.incoming)
 
     def is_valid_action(self, action):
         """
@@ -69,6 +271,37 @@ class State:
                     self.type_validity_cache[action.type_id] = valid
         return valid
 
+    def valid_actions_mask(self, actions):
+        """
+        :param actions: Actions object
+        :return: boolean NumPy array marking which actions in actions.all are valid in the current state
+        Once an action is invalid regardless of its tag, the rest of the actions with the same type are skipped
+        """
+        mask = np.zeros(len(actions.all), dtype=bool)
+        for type_id, indices in actions.type_indices.items():
+            for i in indices:
+                if self.type_validity_cache.get(type_id) is False:
+                    break
+                mask[i] = self.is_valid_action(actions.all[i])
+        return mask
+
+    def single_valid_action(self, actions):
+        """
+        :param actions: Actions object
+        :return: index in actions.all of the only valid action in the current state, or None if there is none or more
+        Stops checking once a second valid action is found, so usually only a few actions are checked
+        """
+        found = None
+        for type_id, indices in actions.type_indices.items():
+            for i in indices:
+                if self.type_validity_cache.get(type_id) is False:
+                    break
+                if self.is_valid_action(actions.all[i]):
+                    if found is not None:
+                        return None
+                    found = i
+        return found
+
     def check_valid_action(self, action, message=False):
         """
         Raise InvalidActionError if the action is invalid in the current state
@@ -78,19 +311,22 @@ class State:
         def _check_possible_node():
             self.check(self.node_ratio() < self.args.max_node_ratio,
                        message and "Non-terminals/terminals ratio: %.3f" % self.args.max_node_ratio, is_type=True)
-            for head in self.heads:
-                self.check(head.height <= self.args.max_height,
-                           message and "Graph height: %d" % self.args.max_height, is_type=True)
+            self.check(not self.head_heights or -self.head_heights[0][0] <= self.args.max_height,
+                       message and "Graph height: %d" % self.args.max_height, is_type=True)
+
+        def _check_tag_rules(node, t, direction):
+            rule = self.constraint_tables.violated_rule(node, t, direction)
+            if rule is not None:
+                raise InvalidActionError(message and rule.violation(node, t, direction, message=True))
 
         def _check_possible_parent(node, t):
             self.check(node.text is None, message and "Terminals may not have children: %s" % node.text, is_type=True)
             if self.args.constraints and t is not None:
-                for rule in self.constraints.tag_rules:
-                    violation = rule.violation(node, t, Direction.outgoing, message=message)
-                    self.check(violation is None, violation)
-                self.check(self.constraints.allow_parent(node, t),
-                           message and "%s may not be a '%s' parent (currently %s)" % (
-                               node, t, ", ".join(map(str, node.outgoing)) or "childless"))
+                _check_tag_rules(node, t, Direction.outgoing)
+                if self.constraint_tables.allow_parent:
+                    self.check(self.constraint_tables.allow_parent(node, t),
+                               message and "%s may not be a '%s' parent (currently %s)" % (
+                                   node, t, ", ".join(map(str, node.outgoing)) or "childless"))
             self.check(not self.constraints.require_implicit_childless or not node.implicit,
                        message and "Implicit nodes may not have children: %s" % s0, is_type=True)
 
@@ -100,13 +336,12 @@ class State:
                 self.check(not t or (node.text is None) != (t == EdgeTags.Terminal),
                            message and "Edge tag must be %s iff child is terminal, but node %s has edge tag %s" %
                            (EdgeTags.Terminal, node, t))
-                for rule in self.constraints.tag_rules:
-                    violation = rule.violation(node, t, Direction.incoming, message=message)
-                    self.check(violation is None, violation)
-                self.check(self.constraints.allow_child(node, t),
-                           message and "%s may not be a '%s' child (currently %s, %s)" % (
-                               node, t, ", ".join(map(str, node.incoming)) or "parentless",
-                               ", ".join(map(str, node.outgoing)) or "childless"))
+                _check_tag_rules(node, t, Direction.incoming)
+                if self.constraint_tables.allow_child:
+                    self.check(self.constraint_tables.allow_child(node, t),
+                               message and "%s may not be a '%s' child (currently %s, %s)" % (
+                                   node, t, ", ".join(map(str, node.incoming)) or "parentless",
+                                   ", ".join(map(str, node.outgoing)) or "childless"))
             self.check(self.constraints.possible_multiple_incoming is None or t is None or
                        action.remote or t in self.constraints.possible_multiple_incoming or
                        all(e.remote or e.tag in self.constraints.possible_multiple_incoming for e in node.incoming),
@@ -125,12 +360,15 @@ class State:
             self.check(self.constraints.allow_root_terminal_children or p is not self.root or c.text is None,
                        message and "Terminal child '%s' for root" % c, is_type=True)
             if self.constraints.multigraph:  # Nodes may be connected by more than one edge
-                edge = Edge(p, c, t, remote=action.remote)
-                self.check(self.constraints.allow_edge(edge), message and "Edge not allowed: %s (currently: %s)" % (
-                               edge, ", ".join(map(str, p.outgoing)) or "childless"))
+                if self.constraint_tables.allow_edge:
+                    edge = Edge(p, c, t, remote=action.remote)
+                    self.check(self.constraint_tables.allow_edge(edge),
+                               message and "Edge not allowed: %s (currently: %s)" % (
+                                   edge, ", ".join(map(str, p.outgoing)) or "childless"))
             else:  # Simple graph, i.e., no more than one edge between the same pair of nodes
                 self.check(c not in p.children, message and "%s is already %s's child" % (c, p), is_type=True)
-            self.check(p not in c.descendants, message and "Detected cycle by edge: %s->%s" % (p, c), is_type=True)
+            self.check(not self.is_descendant(p, c), message and "Detected cycle by edge: %s->%s" % (p, c),
+                       is_type=True)
 
         def _check_possible_label():
             self.check(self.args.node_labels, message and "Node labels disabled", is_type=True)
@@ -150,13 +388,15 @@ class State:
         if action.is_type(Actions.Finish):
             self.check(not self.buffer, "May only finish at the end of the input buffer", is_type=True)
             if self.args.swap:  # Without swap, the oracle may be incapable even of single action
-                self.check(self.root.outgoing or all(n is self.root or n.is_linkage or n.text for n in self.nodes),
+                self.check(self.root.outgoing or not self.non_terminals,
                            message and "Root has no child at parse end", is_type=True)
-            for n in self.nodes:
-                self.check(not self.args.require_connected or n is self.root or n.is_linkage or n.text or
-                           n.incoming, message and "Non-terminal %s has no parent at parse end" % n, is_type=True)
-                self.check(not self.args.node_labels or n.text or n.labeled,
-                           message and "Non-terminal %s has no label at parse end" % n, is_type=True)
+            self.check(not self.args.require_connected or not self.parentless, message and self.parentless and
+                       "Non-terminal %s has no parent at parse end" % next(
+                           n for n in self.nodes if not (n is self.root or n.is_linkage or n.text or n.incoming)),
+                       is_type=True)
+            self.check(not self.args.node_labels or not self.unlabeled, message and self.unlabeled and
+                       "Non-terminal %s has no label at parse end" % next(
+                           n for n in self.nodes if not (n.text or n.labeled)), is_type=True)
         else:
             self.check(self.action_ratio() < self.args.max_action_ratio,
                        message and "Actions/terminals ratio: %.3f" % self.args.max_action_ratio, is_type=True)
@@ -219,6 +459,15 @@ class State:
             return False
         return True
 
+    def valid_labels_mask(self, labels):
+        """
+        :param labels: list of labels
+        :return: boolean NumPy array marking which labels are valid in the current state
+        """
+        if not self.args.constraints:
+            return np.ones(len(labels), dtype=bool)
+        return np.fromiter(map(self.is_valid_label, labels), dtype=bool, count=len(labels))
+
     def check_valid_label(self, label, message=False):
         if self.args.constraints and label is not None:
             valid = self.constraints.allow_label(self.need_label, label)
@@ -236,9 +485,12 @@ class State:
         :param action: Action object to apply
         """
         action.apply()
+        self._own("history")
         self.log = []
         pct = self.get_parent_child_tag(action)
         if pct:
+            if self._own("graph"):  # Get the parent and child from the copy
+                pct = self.get_parent_child_tag(action)
             parent, child, tag = pct
             if parent is None:
                 parent = action.node = self.add_node(orig_node=action.orig_node)
@@ -246,18 +498,35 @@ class State:
                 child = action.node = self.add_node(orig_node=action.orig_node, implicit=True)
             action.edge = self.add_edge(Edge(parent, child, tag, remote=action.remote))
             if action.node:
+                self._own("sequence")
+                self.buffer_hash = (self.buffer_hash + position_hash(action.node, len(self.buffer))) % HASH_MODULUS
                 self.buffer.appendleft(action.node)
         elif action.is_type(Actions.Shift):  # Push buffer head to stack; shift buffer
+            self._own("sequence")
+            node = self.buffer[0]
+            self.buffer_hash = (self.buffer_hash - position_hash(node, len(self.buffer) - 1)) % HASH_MODULUS
+            self.stack_hash = (self.stack_hash + position_hash(node, len(self.stack))) % HASH_MODULUS
             self.stack.append(self.buffer.popleft())
         elif action.is_type(Actions.Label):
             self.need_label = self.stack[-action.tag]  # The parser is responsible to choose a label and set it
         elif action.is_type(Actions.Reduce):  # Pop stack (no more edges to create with this node)
+            self._own("sequence")
+            self.stack_hash = (self.stack_hash - position_hash(self.stack[-1], len(self.stack) - 1)) % HASH_MODULUS
             self.stack.pop()
         elif action.is_type(Actions.Swap):  # Place second (or more) stack item back on the buffer
+            self._own("sequence")
             distance = action.tag or 1
             s = slice(-distance - 1, -1)
             self.log.append("%s <--> %s" % (", ".join(map(str, self.stack[s])), self.stack[-1]))
-            self.buffer.extendleft(reversed(self.stack[s]))  # extendleft reverses the order
+            swapped = self.stack[s]
+            top = len(self.stack) - 1
+            self.stack_hash = (self.stack_hash - sum(position_hash(node, top - distance + i)
+                                                     for i, node in enumerate(swapped)) -
+                               position_hash(self.stack[-1], top) +
+                               position_hash(self.stack[-1], top - distance)) % HASH_MODULUS
+            self.buffer_hash = (self.buffer_hash + sum(position_hash(node, len(self.buffer) + i)
+                                                       for i, node in enumerate(reversed(swapped)))) % HASH_MODULUS
+            self.buffer.extendleft(reversed(swapped))  # extendleft reverses the order
             del self.stack[s]
         elif action.is_type(Actions.Finish):  # Nothing left to do
             self.finished = True
@@ -279,7 +548,11 @@ class State:
         if self.args.verify:
             assert node not in self.nodes, "Node already exists"
         self.nodes.append(node)
+        self.descendants.append(1 << node.index)
+        self.ancestors.append(1 << node.index)
         self.heads.add(node)
+        heapq.heappush(self.head_heights, (-node.height, node.index))
+        self._count(node, 1)
         self.log.append("node: %s (swap_index: %g)" % (node, node.swap_index))
         if self.args.use_gold_node_labels:
             self.need_label = node  # Labeled the node as soon as it is created rather than applying a LABEL action
@@ -304,11 +577,42 @@ class State:
         return None
 
     def add_edge(self, edge):
+        if self.args.verify:
+            assert not self.is_descendant(edge.parent, edge.child), "Detected cycle created by edge: %s" % edge
+        height = edge.parent.height
+        self._count(edge.parent, -1)
+        self._count(edge.child, -1)
         edge.add()
+        self._count(edge.parent, 1)
+        self._count(edge.child, 1)
+        self.edges_hash ^= edge_hash(edge)
+        descendants = self.descendants[edge.child.index]
+        ancestors = self.ancestors[edge.parent.index]
+        for i in bit_indices(ancestors):  # The child's descendants are now descendants of all the parent's ancestors
+            self.descendants[i] |= descendants
+            self.nodes[i].version += 1  # Gap features depend on terminal_bits, also of children
+        if not edge.remote:  # Terminals under remote children are not in the span, as in FoundationalNode.get_terminals
+            terminal_bits = edge.child.terminal_bits
+            nodes = [edge.parent]
+            while nodes:  # Stop at nodes that already have them: so do all their ancestors by primary edges
+                node = nodes.pop()
+                if node.terminal_bits | terminal_bits != node.terminal_bits:
+                    node.terminal_bits |= terminal_bits
+                    nodes += [e.parent for e in node.incoming if not e.remote]
+        for i in bit_indices(descendants):
+            self.ancestors[i] |= ancestors
         self.heads.discard(edge.child)
+        if edge.parent.height != height and edge.parent in self.heads:
+            heapq.heappush(self.head_heights, (-edge.parent.height, edge.parent.index))
+        while self.head_heights:  # Drop entries of nodes that are no longer heads, or have grown taller since
+            height, index = self.head_heights[0]
+            node = self.nodes[index]
+            if node in self.heads and node.height == -height:
+                break
+            heapq.heappop(self.head_heights)
         self.log.append("edge: %s" % edge)
         return edge
-    
+
     PARENT_CHILD = (
         ((Actions.LeftEdge, Actions.LeftRemote), (-1, -2)),
         ((Actions.RightEdge, Actions.RightRemote), (-2, -1)),
@@ -331,9 +635,20 @@ class State:
         except IndexError:
             return None
 
+    def is_descendant(self, node, ancestor):
+        """
+        :return: is node reachable from ancestor by following edges (or is it the same node)? No graph traversal needed
+        """
+        return self.descendants[ancestor.index] >> node.index & 1
+
     def label_node(self, label):
+        self._own("graph")
+        self._own("history")
+        self._count(self.need_label, -1)
         self.need_label.label = label
         self.need_label.labeled = True
+        self.need_label.version += 1
+        self._count(self.need_label, 1)
         self.log.append("label: %s" % self.need_label)
         self.type_validity_cache = {}
         self.need_label = None
@@ -345,21 +660,37 @@ class State:
         :return: core.Passage created from self.nodes
         """
         Config().print("Creating passage %s from state..." % self.passage.ID, level=2)
+        self._own("graph")  # Nodes are sorted and linked to the new passage's nodes
         passage = core.Passage(self.passage.ID)
         passage_format = kwargs.get("format") or self.passage.extra.get("format")
         if passage_format:
             passage.extra["format"] = passage_format
-        self.passage.layer(layer0.LAYER_ID).copy(passage)
-        l0 = passage.layer(layer0.LAYER_ID)
+        original_l0 = self.passage.layer(layer0.LAYER_ID)
+        l0 = layer0.Layer0(passage, attrib=original_l0.attrib.copy())
+        l0.extra = original_l0.extra.copy()
         l1 = layer1.Layer1(passage)
-        self.root.node = l1.heads[0]
-        if self.args.node_labels:
-            self.root.set_node_label()
-        if self.labeled:  # We have a reference passage
-            self.root.set_node_id()
-        Node.attach_nodes(l0, l1, self.nodes, self.labeled, self.args.node_labels, verify)
+        with bulk_creation(l0, l1):
+            for terminal in original_l0.all:  # Like Layer0.copy, but without sorting after every terminal
+                l0.add_terminal(terminal.text, terminal.punct, terminal.paragraph).extra = terminal.extra.copy()
+            self.root.node = l1.heads[0]
+            if self.args.node_labels:
+                self.root.set_node_label()
+            if self.labeled:  # We have a reference passage
+                self.root.set_node_id()
+            Node.attach_nodes(l0, l1, self.nodes, self.labeled, self.args.node_labels, verify)
         return passage
 
+    def punctuation_between(self, first, last):
+        """
+        Takes constant time, using the punctuation counts and indices computed in advance for the terminals
+        :param first: index of a terminal
+        :param last: index of a terminal not before the first one
+        :return: tuple of (number of punctuation terminals strictly between the two, the first of them or None)
+        """
+        index = self.next_punctuation[first + 1]
+        return max(0, self.punctuation_counts[last - 1] - self.punctuation_counts[first]), \
+            self.terminals[index - 1] if index is not None and index < last else None
+
     def node_ratio(self):
         return (len(self.nodes) / len(self.terminals) - 1) if self.terminals else 0
 
@@ -378,4 +709,18 @@ class State:
                self.nodes == other.nodes
 
     def __hash__(self):
-        return hash((tuple(self.stack), tuple(self.buffer), tuple(self.nodes)))
+        """
+        Takes constant time, as the hashes of the stack, buffer and edges are updated with each transition
+        """
+        return hash((self.stack_hash, self.buffer_hash, self.edges_hash, len(self.nodes)))
+
+    def calculate_hashes(self):
+        """
+        :return: hashes of the stack, buffer and edges, calculated from scratch (the buffer is hashed from its end,
+                 since it only changes at its start)
+        """
+        edges_hash = 0
+        for node in self.nodes:
+            for edge in node.outgoing:
+                edges_hash ^= edge_hash(edge)
+        return sequence_hash(self.stack), sequence_hash(reversed(self.buffer)), edges_hash
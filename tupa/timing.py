@@ -0,0 +1,90 @@
+import json
+from collections import OrderedDict
+from time import perf_counter
+
+PHASES = ("oracle", "features", "scoring", "validity", "transition", "passage", "write")
+
+
+class PhaseTimes:
+    """
+    Total seconds and number of calls per parsing phase, timed by `with times("phase"): ...'
+    """
+    def __init__(self):
+        self.seconds = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.counts = OrderedDict((phase, 0) for phase in PHASES)
+
+    def __call__(self, phase):
+        return PhaseTimer(self, phase)
+
+    def update(self, other):
+        """
+        Add the times of another PhaseTimes object to these ones
+        """
+        for phase in PHASES:
+            self.seconds[phase] += other.seconds[phase]
+            self.counts[phase] += other.counts[phase]
+
+    def to_dict(self):
+        return OrderedDict((phase, OrderedDict((("seconds", self.seconds[phase]), ("count", self.counts[phase]))))
+                           for phase in PHASES)
+
+    def __str__(self):
+        return ", ".join("%s %.3fs (%d)" % (phase, self.seconds[phase], self.counts[phase])
+                         for phase in PHASES if self.counts[phase])
+
+
+class PhaseTimer:
+    __slots__ = ("times", "phase", "started")
+
+    def __init__(self, times, phase):
+        self.times = times
+        self.phase = phase
+        self.started = None
+
+    def __enter__(self):
+        self.started = perf_counter()
+
+    def __exit__(self, *_):
+        self.times.seconds[self.phase] += perf_counter() - self.started
+        self.times.counts[self.phase] += 1
+
+
+class NoTimes:
+    """
+    Stand-in for PhaseTimes when timing is disabled, so that timed code needs no condition
+    """
+    def __call__(self, phase):
+        return NO_TIMER
+
+    def __bool__(self):
+        return False
+
+    def update(self, other):
+        pass
+
+
+class NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+
+NO_TIMES = NoTimes()
+NO_TIMER = NoTimer()
+
+
+def write_times(filename, total, passages):
+    """
+    :param filename: JSON file to write to
+    :param total: PhaseTimes for the whole run
+    :param passages: dict of passage ID -> PhaseTimes
+    """
+    try:
+        with open(filename, "w") as f:
+            json.dump(OrderedDict((("total", total.to_dict()),
+                                   ("passages", OrderedDict((i, t.to_dict()) for i, t in passages.items())))),
+                      f, indent=2)
+    except OSError:
+        pass